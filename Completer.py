@@ -1,6 +1,9 @@
 import readline
 import os
 import sys
+import queue
+import threading
+from bisect import bisect_left
 from types import ModuleType
 
 def get_tree_options(already, tree, rtn, path=None):
@@ -22,38 +25,134 @@ def get_code_options(already, path, rtn):
             new_path = path + [i]
             rtn.append(".".join(new_path[1:]))
 
+class PrefixIndex(object):  # sorted names, a prefix is a contiguous run
+    def __init__(self, names):
+        self.names = sorted(set(names))
+
+    def matches(self, prefix):
+        rtn = []
+        for i in range(bisect_left(self.names, prefix), len(self.names)):
+            if not self.names[i].startswith(prefix):
+                break
+            rtn.append(self.names[i])
+        return rtn
+
+class DirectoryListing(object):  # filled in the background, readable while it fills
+    def __init__(self, path, mtime):
+        self.path = path
+        self.mtime = mtime
+        self.names = []
+        self.index = None
+        self.done = threading.Event()
+
+    def fill(self):
+        try:
+            with os.scandir(self.path) as entries:
+                for entry in entries:
+                    self.names.append(entry.name)
+        except OSError:
+            pass
+        self.index = PrefixIndex(self.names)
+        self.done.set()
+
+    def matches(self, prefix):
+        if self.index is not None:
+            return self.index.matches(prefix)
+        return sorted([n for n in self.names[:] if n.startswith(prefix)])
+
 class Completer(object):  # Custom completer
     def __init__(self, dictionary):
         self.dictionary = dictionary
+        self.matches = []
+        # directory listings are kept until the directory's mtime changes
+        self.directories = {}
+        self.names = None
+        self.names_key = None
+        self.cwd = None
+        self.tasks = queue.Queue()
+        self.worker = None
+
+    def submit(self, task):
+        if self.worker is None:
+            self.worker = threading.Thread(target=self.work, daemon=True)
+            self.worker.start()
+        self.tasks.put(task)
+
+    def work(self):
+        while True:
+            task = self.tasks.get()
+            try:
+                task()
+            except Exception:
+                pass
+
+    def budget(self):
+        return self.dictionary.get("completion", {}).get("budget_ms", 20) / 1000
+
+    def warm(self):
+        # runs before each prompt, so a cd is followed by a listing of the new directory
+        cwd = os.getcwd()
+        if cwd != self.cwd:
+            self.cwd = cwd
+            self.directory_index(cwd)
+            self.submit(self.name_index)
     
     def modules(self):
         return self.dictionary["modules"]
 
+    def directory_index(self, path="."):
+        path = os.path.abspath(path)
+        mtime = os.stat(path).st_mtime_ns
+        cached = self.directories.get(path)
+        if cached is None or cached.mtime != mtime:
+            cached = DirectoryListing(path, mtime)
+            self.directories[path] = cached
+            self.submit(cached.fill)
+        return cached
+
+    def name_index(self):
+        # rebuilt only when modules or environment keys come and go
+        key = (len(self.dictionary), tuple([(id(m), len(vars(m))) for m in self.modules()]))
+        if key != self.names_key:
+            names = [str(k) for k in self.dictionary.keys()]
+            for m in self.modules():
+                names += dir(m)
+            self.names = PrefixIndex(names)
+            self.names_key = key
+        return self.names
+
+    def resolve(self, heads):
+        cur = self.dictionary
+        for i, head in enumerate(heads):
+            if isinstance(cur, dict) and head in cur:
+                cur = cur[head]
+            elif i == 0 and any([hasattr(m, head) for m in self.modules()]):
+                cur = getattr([m for m in self.modules() if hasattr(m, head)][0], head)
+            elif i > 0 and hasattr(cur, head):
+                cur = getattr(cur, head)
+            else:
+                return None
+        return cur
+
     def complete(self, text, state):
         if state == 0:  # on first trigger, build possible matches
-            if not text:
-                self.matches = self.options[:]
-            else:
-                if "." in text:
-                    heads = text.split(".")[:-1]
-                    tail = text.split(".")[-1]
-                    cur = self.dictionary
-                    for i in heads:
-                        cur = cur.get(i, None)
-                        if cur is None:
-                            break
-                    
-                    if cur != None:
-                        keys = [str(k) for k in cur.keys()]
-                        matching_keys = filter(lambda f: f.startswith(tail), keys)
-                        self.matches = list(map(lambda k: f"{'.'.join(heads + [k])}", matching_keys))
-                    else:
-                        self.matches = list(map(lambda t: f"{'.'.join(heads + [t])}", filter(lambda x: x.startswith(tail), eval(f"dir({'.'.join(heads)})"))))
+            if "." in text:
+                heads = text.split(".")[:-1]
+                tail = text.split(".")[-1]
+                cur = self.resolve(heads)
+                if isinstance(cur, dict):
+                    index = PrefixIndex([str(k) for k in cur.keys()])
+                elif cur is not None:
+                    index = PrefixIndex(dir(cur))
                 else:
-                    self.matches = list(map(lambda x: f"'{x}'", filter(lambda f: f.startswith(text), os.listdir())))
-                    
-                    for m in self.modules():
-                        self.matches += list(filter(lambda f: f.startswith(text), dir(m)))
+                    index = PrefixIndex([])
+                self.matches = [f"{'.'.join(heads + [k])}" for k in index.matches(tail)]
+            else:
+                listing = self.directory_index()
+                # a slow directory gives what has been read so far
+                listing.done.wait(self.budget())
+                self.matches = [f"'{x}'" for x in listing.matches(text)]
+                self.matches += self.name_index().matches(text)
                 
         # return match indexed by state
         try:
@@ -1,65 +1,328 @@
 # this is the lisp
 from functools import reduce
+from collections import OrderedDict
+import pickle
 import sys
-sys.path.append("./modules")
-sys.path.append(".")
-import parts
 import os
+# absolute, so worker processes started after a cd can still import the shell
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import parts
+from util import _scope_
 import shutil
 import re
 
 _image_ = {}
+_pools_ = {}
+_programs_ = OrderedDict()
+_version_ = 0
+_atom_ = re.compile(r"'([^']*)'|\"([^\"]*)\"|\[|\]|[^\s\[\]]+")
+
+class Image(dict):
+  # compiled programs cache what their symbols resolve to, any write to the image makes them look again
+  def changed(self):
+    global _version_
+    _version_ += 1
+
+  def __setitem__(self, key, value):
+    super().__setitem__(key, value)
+    self.changed()
+
+  def __delitem__(self, key):
+    super().__delitem__(key)
+    self.changed()
+
+  def __ior__(self, other):
+    super().update(other)
+    self.changed()
+    return self
+
+  def __or__(self, other):
+    return Image(dict.__or__(self, other))
+
+  def update(self, *args, **kwargs):
+    super().update(*args, **kwargs)
+    self.changed()
+
+  def setdefault(self, key, default=None):
+    if key not in self:
+      self.changed()
+    return super().setdefault(key, default)
+
+  def pop(self, *args):
+    self.changed()
+    return super().pop(*args)
+
+  def popitem(self):
+    self.changed()
+    return super().popitem()
+
+  def clear(self):
+    super().clear()
+    self.changed()
 
 class Lisp(parts.CallablePart):
   def __init__(self, s):
     super().__init__(s)
     self.value = s
+    self.program = compile_lisp(s)
 
   def __str__(self):
     return self.value
   
   def __call__(self, *args):
-    return lisp(self.value, _image_["lisp"])
+    return self.program(_image_["lisp"])
 
-def lisp(s, d):
-  def string_lisp(string):
-    def atoms_to_lisp(atoms):
-      items = []
-      for i, atom in enumerate(atoms):
-        if atoms == '[':
-          items += atoms_to_lisp(atoms[i+1:])
-        elif atoms[0] == ']':
-          items = [items]
-        else:
-          items.append(atom)
-      return items
-    if isinstance(string, list):
-      atoms_to_lisp(string)
+class Literal:
+  def __init__(self, value):
+    self.value = value
+
+  def run(self, frame):
+    return self.value
+
+class Symbol:
+  def __init__(self, name):
+    self.name = name
+    self.value = None
+
+  def function(self, frame):
+    if self.value is None:
+      # names the image does not define may be bound in the shell's current scope
+      return _scope_.find(self.name)
+    return self.value
+
+  def run(self, frame):
+    if self.value is None:
+      return _scope_.find(self.name, self.name)
+    if callable(self.value):
+      return self.value()
+    return self.value
+
+class Local:
+  # a lambda argument, found by counting frames outwards then indexing
+  def __init__(self, name, depth, index):
+    self.name = name
+    self.depth = depth
+    self.index = index
+
+  def function(self, frame):
+    return self.run(frame)
+
+  def run(self, frame):
+    for _ in range(self.depth):
+      frame = frame[1]
+    return frame[0][self.index]
+
+class Call:
+  def __init__(self, head, arguments):
+    self.head = head
+    self.arguments = arguments
+
+  def run(self, frame):
+    f = self.head.function(frame)
+    if f is not None and callable(f):
+      return f(*[a.run(frame) for a in self.arguments])
+    if f is None and isinstance(self.head, Symbol):
+      # an unknown head is data, which is how rule bodies are written
+      return [self.head.name] + [a.run(frame) for a in self.arguments]
+    return None
+
+class Items:
+  def __init__(self, items):
+    self.items = items
+
+  def run(self, frame):
+    return [i.run(frame) for i in self.items]
+
+class Lambda:
+  def __init__(self, program, body):
+    self.program = program
+    self.body = body
+    self.index = len(program.lambdas)
+    program.lambdas.append(self)
+
+  def run(self, frame):
+    return Applied(self, frame, self.program.image)
+
+class Applied:
+  # a lambda with its frame, it pickles as the program text so process pools can run it
+  def __init__(self, lam, frame, image):
+    self.lam = lam
+    self.frame = frame
+    self.image = image
+
+  def __call__(self, *args):
+    self.lam.program.bind(self.image)
+    return self.lam.body.run((args, self.frame))
+
+  def __reduce__(self):
+    program = self.lam.program
+    bound = {}
+    for symbol in program.symbols:
+      try:
+        pickle.dumps(symbol.value)
+        bound[symbol.name] = symbol.value
+      except Exception:
+        continue
+    return (restore_lambda, (program.text, self.lam.index, self.frame, bound))
+
+def restore_lambda(text, index, frame, bound):
+  # runs in a pool worker, the builtins come from on_load and the rest from the sender
+  if "lisp" not in _image_:
+    on_load({"lisp": {}, "statement": {"segments": []}})
+  _image_["lisp"].update(dict([(k, v) for k, v in bound.items() if v is not None]))
+  lam = compile_lisp(text).lambdas[index]
+  return Applied(lam, frame, _image_["lisp"])
+
+class Define:
+  # the name is taken as written, evaluating it would use whatever it is already bound to
+  def __init__(self, name, value):
+    self.name = name
+    self.value = value
+
+  def run(self, frame):
+    return define(self.name, self.value.run(frame))
+
+class Program:
+  def __init__(self, text):
+    self.text = text
+    self.symbols = []
+    self.lambdas = []
+    self.image = None
+    self.version = -1
+    self.root = self.compile(parse(text), [])
+
+  def compile(self, form, scopes):
+    if isinstance(form, list):
+      if len(form) == 0:
+        return Literal([])
+      if form[0] == "\\":
+        if len(form) < 3:
+          raise Exception("lambda needs [\\ name ... body]")
+        return Lambda(self, self.compile(form[-1], scopes + [form[1:-1]]))
+      if form[0] == "define" and len(form) == 3 and not isinstance(form[1], list):
+        return Define(form[1], self.compile(form[2], scopes))
+      if isinstance(form[0], list):
+        return Items([self.compile(f, scopes) for f in form])
+      return Call(self.compile(form[0], scopes), [self.compile(f, scopes) for f in form[1:]])
+    for depth, scope in enumerate(reversed(scopes)):
+      if form in scope:
+        return Local(form, depth, scope.index(form))
+    symbol = Symbol(form)
+    self.symbols.append(symbol)
+    return symbol
+
+  def bind(self, image):
+    # symbols resolve once per image, not on every evaluation
+    if image is not self.image or self.version != _version_:
+      for symbol in self.symbols:
+        symbol.value = image.get(symbol.name, None)
+      self.image = image
+      self.version = _version_
+
+  def __call__(self, image):
+    self.bind(image)
+    return self.root.run(None)
+
+def parse(s):
+  stack = [[]]
+  for match in _atom_.finditer(s):
+    atom = match.group()
+    if match.group(1) is not None or match.group(2) is not None:
+      # a quoted atom is taken literally, brackets and spaces included
+      stack[-1].append(match.group(1) if match.group(1) is not None else match.group(2))
+    elif atom == '[':
+      stack.append([])
+    elif atom == ']':
+      if len(stack) < 2:
+        raise Exception(f"unbalanced ] in [{s}]")
+      inner = stack.pop()
+      stack[-1].append(inner)
     else:
-      atoms_to_lisp(string.replace('[', ' [ ').replace(']', ' ] ').split())
-  def run(l):
-    if isinstance(l, list):
-      if not isinstance(l[0], list):
-        v = d.get(l[0], None)         
-        if v is not None and callable(v):
-          return v(*[run(i) for i in l[1:]])
-      else:
-        return [run(i) for i in l]
+      stack[-1].append(atom)
+  if len(stack) > 1:
+    raise Exception(f"unbalanced [ in [{s}]")
+  return stack[0]
+
+def compile_lisp(s):
+  program = _programs_.get(s, None)
+  if program is None:
+    program = Program(s)
+    _programs_[s] = program
+    if len(_programs_) > _image_.get("statement_cache", 256):
+      _programs_.popitem(last=False)
+  else:
+    _programs_.move_to_end(s)
+  return program
+
+def lisp(s, d):
+  return compile_lisp(s)(d)
+
+def define(name, value):
+  global _version_
+  _image_["lisp"][str(name)] = value
+  _version_ += 1
+  return value
+
+def map_chunk(lam, items):
+  return [lam(i) for i in items]
+
+def where_chunk(lam, items):
+  return [i for i in items if lam(i)]
+
+def pool(kind):
+  settings = _image_.get("parallel", {})
+  key = (kind, settings.get("start_method", None))
+  if key not in _pools_:
+    from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+    workers = settings.get("workers", None)
+    if kind == "process":
+      import multiprocessing
+      _pools_[key] = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(key[1]))
     else:
-      v = d.get(l, None)
-      if v is not None:
-        if callable(v):
-          return v()
-        else:
-          return v
-      else:
-        return l
-  return run(string_lisp(s))
+      _pools_[key] = ThreadPoolExecutor(max_workers=workers)
+  return _pools_[key]
+
+def pool_kind(lam):
+  # functions made in the shell have no module a worker could import them from
+  kind = _image_.get("parallel", {}).get("pool", "thread")
+  if kind == "process":
+    if getattr(getattr(lam, "__code__", None), "co_filename", "") == "<string>":
+      return "thread"
+    try:
+      pickle.dumps(lam)
+    except Exception:
+      return "thread"
+  return kind
+
+def parallel(chunk_action, input, lam, chunk=None):
+  settings = _image_.get("parallel", {})
+  items = input.splitlines() if isinstance(input, str) else list(input)
+  if len(items) < settings.get("serial_below", 256):
+    return chunk_action(lam, items)
+  size = max(1, int(chunk if chunk is not None else settings.get("chunk", 64)))
+  chunks = [items[i:i + size] for i in range(0, len(items), size)]
+  from concurrent.futures import BrokenExecutor
+  kind = pool_kind(lam)
+  try:
+    # executor.map yields chunk results in submission order
+    results = list(pool(kind).map(chunk_action, [lam] * len(chunks), chunks))
+  except BrokenExecutor:
+    # a worker could not load the function, the broken pool is dropped and the work runs on threads
+    _pools_.pop((kind, settings.get("start_method", None))).shutdown(wait=False)
+    results = list(pool("thread").map(chunk_action, [lam] * len(chunks), chunks))
+  return [r for result in results for r in result]
+
+def pmap(input, lam, chunk=None):
+  return parallel(map_chunk, input, lam, chunk)
+
+def pwhere(input, lam, chunk=None):
+  return parallel(where_chunk, input, lam, chunk)
 
 def on_load(mdict):
   global _image_
   _image_ = mdict
-  mdict["lisp"] = mdict["lisp"] | {
+  mdict["lisp"] = Image(mdict["lisp"]) | {
     "print": print,
     "ls": os.listdir,
     "cd": os.chdir,
@@ -70,9 +333,11 @@ def on_load(mdict):
     "mv": os.rename,
     "cp": shutil.copy,
     "exp": lambda *a: os.system(f"explorer {''.join([str(i) for i in a])}"),
-    "where": lambda input, lam: filter(lam, input),    
-    "map": lambda input, lam: map(lambda a,b: lam(a)(b), input),    
+    "where": lambda input, lam: list(filter(lam, input)),    
+    "map": lambda input, lam: list(map(lam, input)),    
     "reduce": lambda input, lam: reduce(lam, input),    
-    "\\" : lambda *a: lambda x: taush.dowith(lisp(a[1:], **{a[0].text:x}))
+    "pmap": pmap,
+    "pwhere": pwhere,
+    "define": define,
   }
   mdict["statement"]["segments"].append(("[", "]", Lisp))
\ No newline at end of file
@@ -1,5 +1,14 @@
 import sqlite3
-import taush
+import threading
+import queue
+import csv
+import json
+import sys
+from itertools import chain, islice, count
+from contextlib import contextmanager
+from util import streams, Stream, output_setting
+
+_instance_ = {}
 
 def _dict_factory(cursor, row):
     d = {}
@@ -8,25 +17,100 @@ def _dict_factory(cursor, row):
     return d
 
 def _quote(v):
-  return f"'{v}'"
+  return "'" + str(v).replace("'", "''") + "'"
 
 def _block_quote(v):
   return f"[{v}]"
 
+def _table_quote(v):
+  # tables in attached databases are named schema.table
+  return ".".join([_block_quote(p) for p in str(v).split(".", 1)])
+
+def _split_table(v):
+  parts = str(v).split(".", 1)
+  return (None, parts[0]) if len(parts) == 1 else (parts[0], parts[1])
+
 def _variablize(v):
   return f":{v}"
 
 class Argument:
   def __init__(self, argument_number, argument_type, value):
+    self.argument_number = argument_number
     self.argument_type = argument_type
     self.value = value
 
+class ResultSet(Stream):
+  # query rows read a page at a time, only when they are consumed
+  def __init__(self, db, sql, parameters={}, count=None, offset=0):
+    super().__init__(None, output_setting("limit"))
+    self.db = db
+    self.sql = sql
+    self.parameters = parameters
+    self.count = count
+    self.offset = offset
+
+  def __str__(self):
+    # the rows are read again every time, a query does not keep its text
+    self.text = None
+    return super().__str__()
+
+  def paged_sql(self):
+    if self.count is None and self.offset == 0:
+      return self.sql
+    return f"select * from ({self.sql}) limit {-1 if self.count is None else int(self.count)} offset {int(self.offset)}"
+
+  def __iter__(self):
+    self.db.flush()
+    cursor = self.db.connection().cursor()
+    cursor.row_factory = _dict_factory
+    try:
+      cursor.execute(self.paged_sql(), self.parameters)
+      rows = cursor.fetchmany(self.db.page_size)
+      while len(rows) > 0:
+        yield from rows
+        rows = cursor.fetchmany(self.db.page_size)
+    finally:
+      cursor.close()
+
+  def page(self, count=None, offset=0):
+    offset = int(offset)
+    remaining = None if self.count is None else max(0, self.count - offset)
+    if count is not None:
+      count = int(count) if remaining is None else min(int(count), remaining)
+    else:
+      count = remaining
+    return ResultSet(self.db, self.sql, self.parameters, count, self.offset + offset)
+
+  def take(self, count):
+    return self.page(count)
+
+  def skip(self, offset):
+    return self.page(None, offset)
+
+  def first(self):
+    return next(iter(self.take(1)), None)
+
+  def exists(self):
+    self.db.flush()
+    return self.db.connection().execute(f"select exists({self.paged_sql()})", self.parameters).fetchone()[0] == 1
+
+  def __bool__(self):
+    return self.exists()
+
+  def __len__(self):
+    self.db.flush()
+    return self.db.connection().execute(f"select count(*) from ({self.paged_sql()})", self.parameters).fetchone()[0]
+
 class RuleArgument(Argument):
   table_name = "rule_argument"
   fields = "id INTEGER PRIMARY KEY AUTOINCREMENT ,rule_id INTEGER,seq INTEGER,argument TEXT,argument_type TEXT"
 
-  def __init__(self, argument_number, argument_type, value):
-    super().__init__(argument_number, argument_type, value)
+  def __init__(self, id, rule_id, seq, argument, argument_type):
+    super().__init__(seq, argument_type, argument)
+    self.id = id
+    self.rule_id = rule_id
+    self.db = None
+    self.rule = None
 
   def attach(self, db):
     db.attach(self)
@@ -37,14 +121,16 @@ class RuleArgument(Argument):
     if self.argument_type == 'VAR':
       return self.value
     else:
-      return f"'{self.value}'"
+      return _quote(self.value)
 
 class QueryArgument(Argument):
   table_name = "query_argument"
   fields = "id INTEGER PRIMARY KEY AUTOINCREMENT ,query_id INTEGER,seq INTEGER,argument TEXT,argument_type TEXT"
                               
-  def __init__(self, argument_number, argument_type, value):
-    super().__init__(argument_number, argument_type, value)
+  def __init__(self, id, query_id, seq, argument, argument_type):
+    super().__init__(seq, argument_type, argument)
+    self.id = id
+    self.query_id = query_id
     self.db = None
     self.query = None
 
@@ -57,10 +143,10 @@ class Query:
   table_name = "querie"
   fields = "id INTEGER PRIMARY KEY AUTOINCREMENT ,rule_id INTEGER,seq INTEGER,predicate_id INTEGER"
   
-  def __init__(self, query_id, rule_id, sequence, predicate_id):
-    self.query_id = query_id
+  def __init__(self, id, rule_id, seq, predicate_id):
+    self.id = id
     self.rule_id = rule_id
-    self.sequence = sequence
+    self.seq = seq
     self.predicate_id = predicate_id
     self.arguments = []
     self.db = None
@@ -74,19 +160,18 @@ class Query:
     self.predicate = self.db.data[Predicate.table_name][self.predicate_id]
     self.predicate.queries.append(self)
 
-  def to_sql(self) -> str:
-    return self.db.predicates[self.predicate_id].query(self.arguments)
+  def ordered_arguments(self):
+    return sorted(self.arguments, key=lambda a: a.argument_number)
 
 class Rule:
   table_name = "rule"
   fields = "id INTEGER PRIMARY KEY AUTOINCREMENT ,predicate_id INTEGER"
    
-  def __init__(self, predicate, arguments, queries: [[(str, str)]]):
-    self.id = -1
-    self.predicate = predicate
-    self.predicate.rules[self.id] = self 
-    self.arguments = [Argument(i, argument_type, value) for i, (argument_type, value) in enumerate(arguments)]
-    self.queries = [Query(self, i, qargs) for i, qargs in enumerate(queries)]
+  def __init__(self, id, predicate_id):
+    self.id = id
+    self.predicate_id = predicate_id
+    self.arguments = []
+    self.queries = []
     self.db = None
     self.predicate = None
 
@@ -95,23 +180,130 @@ class Rule:
     self.predicate = db.data[Predicate.table_name][self.predicate_id]
     self.predicate.rules.append(self)
 
-  def wrapping_sql(self, innersql):
-    select_items = [f"{a.to_sql()}  as {self.pred.part_name(a.argument_number)}" for a in self.arguments]
-    return f"select {', '.join(select_items)} from ({innersql})"
-  
-  def to_sql(self) -> str:
-    last_query = None
-    sql = " from "
+  def ordered_queries(self):
+    return sorted(self.queries, key=lambda q: q.seq)
+
+  def is_recursive(self):
+    return any(q.predicate is self.predicate for q in self.queries)
+
+  def shared_variables(self):
+    counts = {}
     for query in self.queries:
-      if last_query is None:
-        sql += f" from ({query.to_sql()}) as Q{query.query_id}"
+      for name in set([a.value for a in query.arguments if a.argument_type == "VAR"]):
+        counts[name] = counts.get(name, 0) + 1
+    return set([name for name, count in counts.items() if count > 1])
+
+  def ordered_arguments(self):
+    return sorted(self.arguments, key=lambda a: a.argument_number)
+
+  def self_query(self):
+    return [q for q in self.queries if q.predicate is self.predicate][0]
+
+  def join(self, queries, source, bindings, froms, conditions, index=False):
+    # source(query) names the table, view, recursive table or delta a query reads from
+    for query in queries:
+      alias = f"Q{len(froms)}"
+      froms.append(f"{source(query)} as {alias}")
+      bound = []
+      for argument in query.ordered_arguments():
+        field = query.predicate.part_name(argument.argument_number)
+        column = f"{alias}.{_block_quote(field)}"
+        if argument.argument_type != "VAR":
+          conditions.append(f"{column} = {_quote(argument.value)}")
+          bound.append(field)
+        elif argument.value in bindings:
+          conditions.append(f"{column} = {bindings[argument.value]}")
+          bound.append(field)
+        else:
+          bindings[argument.value] = column
+      if index:
+        self.db.ensure_index(query.predicate, bound)
+
+  def to_sql(self, source) -> str:
+    bindings = {}
+    conditions = []
+    froms = []
+    self.join(self.ordered_queries(), source, bindings, froms, conditions)
+    selects = []
+    for argument in self.ordered_arguments():
+      field = _block_quote(self.predicate.part_name(argument.argument_number))
+      if argument.argument_type != "VAR":
+        selects.append(f"{_quote(argument.value)} as {field}")
+      elif argument.value in bindings:
+        selects.append(f"{bindings[argument.value]} as {field}")
+      else:
+        raise Exception(f"Variable {argument.value} of {self.predicate.name} is not used in the rule body")
+    sql = f"select {', '.join(selects)} from {', '.join(froms)}"
+    return sql if len(conditions) == 0 else f"{sql} where {' and '.join(conditions)}"
+
+  def delta_sql(self, changed, delta):
+    # one query per occurrence of the changed predicate, the occurrences before it
+    # read the merged rows and the ones after it the stored rows
+    ordered = self.ordered_queries()
+    fields = ', '.join([_block_quote(p.field_name) for p in changed.ordered_parts()])
+    merged = f"(select {fields} from {changed.source()} union all select {fields} from {delta})"
+    sqls = []
+    for i, query in enumerate(ordered):
+      if query.predicate is changed:
+        def source(q, i=i):
+          n = ordered.index(q)
+          if q.predicate is not changed:
+            return q.predicate.source()
+          return delta if n == i else merged if n < i else changed.source()
+        sqls.append(self.to_sql(source))
+    return sqls
+
+  def preserves(self, positions):
+    # left linear: the bound arguments reach the recursive call unchanged
+    head = self.ordered_arguments()
+    call = self.self_query().ordered_arguments()
+    for n in positions:
+      if head[n].argument_type != "VAR" or call[n].argument_type != "VAR" or head[n].value != call[n].value:
+        return False
+    return True
+
+  def passes_through(self, positions):
+    # right linear: the free arguments are handed up unchanged from the recursive call
+    own = self.self_query()
+    head = self.ordered_arguments()
+    call = own.ordered_arguments()
+    names = [a.value for a in head]
+    used = set([a.value for q in self.queries if q is not own for a in q.arguments])
+    used |= set([call[n].value for n in positions])
+    for n in range(len(head)):
+      if n in positions:
+        if head[n].argument_type != "VAR":
+          return False
+      elif head[n].argument_type != "VAR" or call[n].argument_type != "VAR" or head[n].value != call[n].value:
+        return False
+      elif names.count(head[n].value) > 1 or head[n].value in used:
+        return False
+    return True
+
+  def magic_step(self, magic, positions):
+    # derives the bound arguments of the recursive call from those of the head
+    own = self.self_query()
+    head = self.ordered_arguments()
+    call = own.ordered_arguments()
+    bindings = {}
+    froms = [f"{magic} as M"]
+    conditions = []
+    for j, n in enumerate(positions):
+      if head[n].value in bindings:
+        conditions.append(f"M.b{j} = {bindings[head[n].value]}")
+      else:
+        bindings[head[n].value] = f"M.b{j}"
+    self.join([q for q in self.ordered_queries() if q is not own], lambda q: q.predicate.source(), bindings, froms, conditions, True)
+    selects = []
+    for n in positions:
+      if call[n].argument_type != "VAR":
+        selects.append(_quote(call[n].value))
+      elif call[n].value in bindings:
+        selects.append(bindings[call[n].value])
       else:
-        last_query_vars = filter(lambda a: a.argument_type == "VAR", last_query.arguments)
-        query_vars = filter(lambda a: a.argument_type == "VAR", query.arguments)
-        shared = list(set(last_query_vars) & set(query_vars))
-        joins = [f"Q{last_query.query_id}.{s} = {query.query_id}.{s}" for s in shared]
-        sql += f" join ({query.to_sql()}) as Q{query.query_id} on {' and '.join(joins)}"
-    return sql    
+        return None
+    sql = f"select {', '.join(selects)} from {', '.join(froms)}"
+    return sql if len(conditions) == 0 else f"{sql} where {' and '.join(conditions)}"
 
 class Predicate:
   table_name = "predicate"
@@ -123,48 +315,182 @@ class Predicate:
     self.table_name = table_name
     self.rules = []
     self.parts = []
+    self.parts_by_seq = {}
+    self.parts_by_name = {}
     self.queries = []
     self.db = None
     self.query_hook = None
     self.fact_hooks = []
+    self.change_hooks = []
+    self.materialized = False
   
   def attach(self, db):
     db.attach(self)
 
   def part_name(self, part_number):
-    for part in self.parts:
-      if part.part_number == part_number:
-        return part.field_name
-    return str(part_number)
+    part = self.parts_by_seq.get(part_number)
+    return part.field_name if part is not None else str(part_number)
+
+  def find_part(self, field_name):
+    return self.parts_by_name.get(field_name)
+
+  def ordered_parts(self):
+    return sorted(self.parts, key=lambda p: p.seq)
   
   def select(self, argument_definitions):
-    variables = filter(lambda x: x.argument_type == 'VAR', argument_definitions)
-    var_pairs = list(map(lambda x: f"{self.part_name(x.argument_number)} as {x.value}", variables))
-    return f"select {','.join(var_pairs)}"
+    names = {}
+    for x in argument_definitions:
+      if x.argument_type == 'VAR' and x.value not in names:
+        names[x.value] = self.part_name(x.argument_number)
+    if len(names) == 0:
+      return "select 1 as _result_number_"
+    return f"select {','.join([f'{_block_quote(field)} as {_block_quote(name)}' for name, field in names.items()])}"
   
+  def view_name(self):
+    return f"tau_view_{self.name}_{self.arity}"
+
+  def materialized_name(self):
+    return f"tau_mat_{self.name}_{self.arity}"
+
+  def is_recursive(self):
+    return any([r.is_recursive() for r in self.rules])
+
+  def reads(self, other, seen=None):
+    seen = set() if seen is None else seen
+    seen.add(self.id)
+    for rule in self.rules:
+      for query in rule.queries:
+        if query.predicate is other:
+          return True
+        if not query.predicate.materialized and query.predicate.id not in seen and query.predicate.reads(other, seen):
+          return True
+    return False
+
+  def depends_on(self, other, seen=None):
+    # every predicate the rules reach, materialized ones included
+    seen = set() if seen is None else seen
+    seen.add(self.id)
+    for rule in self.rules:
+      for query in rule.queries:
+        if query.predicate is other:
+          return True
+        if query.predicate.id not in seen and query.predicate.depends_on(other, seen):
+          return True
+    return False
+
+  def reads_through_views(self, other):
+    return any([q.predicate is not other and not q.predicate.materialized and q.predicate.reads(other, set([self.id])) for r in self.rules for q in r.queries])
+
+  def source(self):
+    if self.materialized:
+      return _block_quote(self.materialized_name())
+    if len(self.rules) > 0 and self.spans_databases():
+      return f"({self.rules_sql()})"
+    if len(self.rules) > 0:
+      return _block_quote(self.view_name())
+    return _table_quote(self.table_name)
+
+  def spans_databases(self, seen=None):
+    # views in main cannot read attached databases, such rules are inlined instead
+    seen = set() if seen is None else seen
+    if self.id in seen:
+      return False
+    seen.add(self.id)
+    if self.table_name is not None and _split_table(self.table_name)[0] is not None:
+      return True
+    return any([q.predicate.spans_databases(seen) for r in self.rules for q in r.queries])
+
   def froms(self):
+    yield self.source()
+
+  def base_sql(self):
+    fields = ', '.join([_block_quote(p.field_name) for p in self.ordered_parts()])
+    base = [f"select {fields} from {_table_quote(self.table_name)}"] if self.table_name is not None else []
+    return base + [r.to_sql(lambda q: q.predicate.source()) for r in self.rules if not r.is_recursive()]
+
+  def rules_sql(self, bound={}):
+    fields = ', '.join([_block_quote(p.field_name) for p in self.ordered_parts()])
+    recursive = [r for r in self.rules if r.is_recursive()]
+    base = self.base_sql()
+    if len(bound) > 0:
+      where = ' and '.join([f"{_block_quote(self.part_name(n))} = {v}" for n, v in bound.items()])
+      base = [f"select * from ({b}) where {where}" for b in base]
+      if self.table_name is not None:
+        self.db.ensure_index(self, [self.part_name(n) for n in bound])
+    if len(recursive) == 0:
+      return " union ".join(base)
+    if len(base) == 0:
+      raise Exception(f"Recursive predicate {self.name}/{self.arity} needs a non recursive rule or facts")
+    for rule in recursive:
+      if len([q for q in rule.queries if q.predicate is self]) > 1:
+        raise Exception(f"Rule for {self.name}/{self.arity} may only refer to itself once")
+    # union keeps each derived row once, sqlite then only joins new rows (semi-naive)
+    cte = _block_quote(f"tau_rec_{self.name}_{self.arity}")
+    steps = [r.to_sql(lambda q: cte if q.predicate is self else q.predicate.source()) for r in recursive]
+    return f"with recursive {cte}({fields}) as ({' union '.join(base + steps)}) select {fields} from {cte}"
+
+  def magic_sql(self, bound, steps):
+    # answers are the base cases reached from every binding the recursion passes down
+    positions = sorted(bound)
+    magic = _block_quote(f"tau_magic_{self.name}_{self.arity}")
+    columns = ', '.join([f"b{j}" for j in range(len(positions))])
+    seed = f"select {', '.join([bound[n] for n in positions])}"
+    selects = ', '.join([f"{bound[p.seq]} as {_block_quote(p.field_name)}" if p.seq in bound else f"B.{_block_quote(p.field_name)}" for p in self.ordered_parts()])
+    matches = ' and '.join([f"B.{_block_quote(self.part_name(n))} = M.b{j}" for j, n in enumerate(positions)])
     if self.table_name is not None:
-      yield f"(select * from {self.table_name})"
-    for rule in self.rules:
-      yield f"({rule.to_sql()})"
+      self.db.ensure_index(self, [self.part_name(n) for n in positions])
+    # a row reached from several bindings is answered once
+    answers = [f"select distinct {selects} from ({b}) as B, {magic} as M where {matches}" for b in self.base_sql()]
+    return f"with recursive {magic}({columns}) as ({' union '.join([seed] + steps)}) {' union '.join(answers)}"
+
+  def bound_source(self, bound):
+    # constants are pushed into recursive rules when the recursion shape allows it
+    recursive = [r for r in self.rules if r.is_recursive()]
+    if len(bound) == 0 or len(recursive) == 0 or self.materialized:
+      return self.source()
+    if all([r.preserves(bound) for r in recursive]):
+      return f"({self.rules_sql(bound)})"
+    if all([r.passes_through(bound) for r in recursive]):
+      magic = _block_quote(f"tau_magic_{self.name}_{self.arity}")
+      steps = [r.magic_step(magic, sorted(bound)) for r in recursive]
+      if all([step is not None for step in steps]):
+        return f"({self.magic_sql(bound, steps)})"
+    return self.source()
 
   def filter(self, argument_definitions):
-    constants = filter(lambda x: x.argument_type == 'CONST', argument_definitions)
-    const_pairs = list(map(lambda x: f"{self.part_name(x.argument_number)} = '{x.value}'", constants))
-    return f"{' and '.join(const_pairs)}"
+    pairs = []
+    first = {}
+    for x in argument_definitions:
+      field = self.part_name(x.argument_number)
+      if x.argument_type == 'CONST':
+        pairs.append(f"{_block_quote(field)} = :a{x.argument_number}")
+      elif x.value in first:
+        pairs.append(f"{_block_quote(field)} = {_block_quote(first[x.value])}")
+      else:
+        first[x.value] = field
+    return ' and '.join(pairs)
+
+  def bound_fields(self, argument_definitions):
+    return [self.part_name(x.argument_number) for x in argument_definitions if x.argument_type == 'CONST']
 
   # this should run it against the db.
   def query(self, argument_definitions):
     if self.query_hook is not None:
       return self.query_hook(self, argument_definitions)
     else:
-      return self.db.data_query(self.query_sql(argument_definitions))
+      self.db.record_usage(self, self.bound_fields(argument_definitions))
+      sql, parameters = self.db.plan(self, argument_definitions)
+      return ResultSet(self.db, sql, parameters)
   
-  def insert_sql(self, values) -> str:
-    return f"insert into {self.table_name} ({', '.join([p.field_name for p in self.parts])}) values ({', '.join([_quote(v) for v in values])})"
+  def insert_sql(self) -> str:
+    fields = [_block_quote(p.field_name) for p in sorted(self.parts, key=lambda p: p.seq)]
+    return f"insert into {_table_quote(self.table_name)} ({', '.join(fields)}) values ({', '.join(['?'] * len(fields))})"
     
   def query_sql(self, argument_definitions):
-    return f"{self.select(argument_definitions)} from {'union'.join(self.froms())} where {self.filter(argument_definitions)}"
+    where = self.filter(argument_definitions)
+    bound = dict([(x.argument_number, f":a{x.argument_number}") for x in argument_definitions if x.argument_type == 'CONST'])
+    sql = f"{self.select(argument_definitions)} from {self.bound_source(bound)}"
+    return sql if where == "" else f"{sql} where {where}"
 
   def declare(self, argument_definitions):
     if len(self.fact_hooks) > 0:
@@ -172,7 +498,7 @@ class Predicate:
     elif self.table_name is None:
       raise Exception(f"Predicate {self.name}/{self.arity} is not a table")
     else:
-      return self.insert_sql([a.value for a in argument_definitions])
+      return self.insert_sql()
 
 class PredicatePart:
   table_name = "predicate_part"
@@ -194,13 +520,15 @@ class PredicatePart:
     db.attach(self)
     self.predicate = self.db.data[Predicate.table_name][self.predicate_id]
     self.predicate.parts.append(self)
+    self.predicate.parts_by_seq[self.seq] = self
+    self.predicate.parts_by_name[self.field_name] = self
 
 class Link:
   table_name = "link"
   fields = "id INTEGER PRIMARY KEY AUTOINCREMENT ,link_name TEXT,local_part_id INTEGER,remote_part_id INTEGER"
   
-  def __init__(self, link_id, link_name, local_part_id, remote_part_id):
-    self.link_id = link_id
+  def __init__(self, id, link_name, local_part_id, remote_part_id):
+    self.id = id
     self.link_name = link_name
     self.local_part_id = local_part_id
     self.remote_part_id = remote_part_id
@@ -210,20 +538,24 @@ class Link:
 
   def attach(self, db):
     db.attach(self)
-    self.local_part = self.db.predicate_parts[self.local_part_id]
+    self.local_part = self.db.data[PredicatePart.table_name][self.local_part_id]
     self.local_part.links_out.append(self)
-    self.remote_part = self.db.predicate_parts[self.remote_part_id]
-    self.local_part.links_in.append(self)
+    self.remote_part = self.db.data[PredicatePart.table_name][self.remote_part_id]
+    self.remote_part.links_in.append(self)
 
 class ArgumentDefintion:
-  def __init__(self, value):
-    self.argument_type = "VAR" if value == value.upper() else "CONST"
+  def __init__(self, value, argument_number=None):
+    value = str(value)
+    # upper case names are variables, values without letters are constants
+    is_var = value.startswith("_") or (value == value.upper() and value != value.lower())
+    self.argument_type = "VAR" if is_var else "CONST"
+    self.argument_number = argument_number
     self.value = value
 
 class FactDefinition:
   def __init__(self, predicate_name, arguments):
     self.predicate_name = predicate_name
-    self.arguments = [ArgumentDefintion(a) for a in arguments]
+    self.arguments = [ArgumentDefintion(a, i) for i, a in enumerate(arguments)]
 
   @classmethod
   def from_list(cls, lst):
@@ -232,7 +564,7 @@ class FactDefinition:
 class RuleDefinition:
   def __init__(self, predicate_name: str, arguments: [str], queries: [FactDefinition]):
     self.predicate_name = predicate_name
-    self.arguments = [ArgumentDefintion(a) for a in arguments]
+    self.arguments = [ArgumentDefintion(a, i) for i, a in enumerate(arguments)]
     self.queries = queries
 
   @classmethod
@@ -246,40 +578,147 @@ class PredicateHook:
     self.action = action
     
 class CustomPredicate:
-  def __ini__(self, predicate_name, arguments, query_hook=None, fact_hooks=[]):
+  # a predicate answered by python hooks instead of a table
+  def __init__(self, predicate_name, arguments, query_hook=None, fact_hooks=[]):
     self.predicate_name = predicate_name
+    self.arguments = arguments
     self.arity = len(arguments)
-    self.action = self.action
+    self.query_hook = query_hook
+    self.fact_hooks = list(fact_hooks)
 
 classes = [Predicate, PredicatePart, Rule, RuleArgument, Query, QueryArgument, Link]
 
 class LogicDB:
-  def __init__(self, file_name):
+  def __init__(self, file_name, cached_statements=512, batch_size=10000, index_after=2, max_indexes=4, page_size=256, write_behind=False):
     self.file_name = file_name
+    self.write_behind = write_behind
+    # facts waiting for the writer thread, and the first error it hit
+    self.pending = queue.Queue()
+    self.writer = None
+    self.write_error = None
+    self.page_size = page_size
+    self.cached_statements = cached_statements
+    self.batch_size = batch_size
+    self.index_after = index_after
+    self.max_indexes = max_indexes
+    self.index_usage = {}
+    self.auto_indexes = {}
+    self.plans = {}
     self.data = {}
+    # lookups by (name, arity), by name alone and by link endpoints, kept up to date by attach
+    self.predicates = {}
+    self.predicates_by_name = {}
+    self.links = {}
+    self.materialized = {}
+    self.delta_numbers = count(1)
+    self._new_id_dict = {}
+    self.tables = set()
+    self.local = threading.local()
+    self.connections = []
+    # schema name to file, every thread's connection attaches the same set
+    self.attached = {}
+    self.attached_version = 0
     self.create()
     self.load()
-    self._new_id_dict = {}
+
+  def connection(self):
+    # one long lived connection per thread, sqlite connections are not shared
+    conn = getattr(self.local, "connection", None)
+    if conn is None:
+      if self.file_name == ":memory:":
+        # a named shared cache lets every thread see the same memory database
+        conn = sqlite3.connect(f"file:tau_memory_{id(self)}?mode=memory&cache=shared", uri=True, cached_statements=self.cached_statements, check_same_thread=False)
+      else:
+        conn = sqlite3.connect(self.file_name, cached_statements=self.cached_statements, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+      self.local.connection = conn
+      self.local.depth = 0
+      self.local.attached = {}
+      self.local.attached_version = 0
+      self.connections.append(conn)
+    if self.local.attached_version != self.attached_version and self.local.depth == 0:
+      self.sync_attached(conn)
+    return conn
+
+  def sync_attached(self, conn):
+    for name in [n for n in self.local.attached if self.local.attached[n] != self.attached.get(n)]:
+      conn.execute(f"detach database {_block_quote(name)}")
+      del self.local.attached[name]
+    for name, file_name in self.attached.items():
+      if name not in self.local.attached:
+        conn.execute("attach database ? as " + _block_quote(name), (file_name,))
+        self.local.attached[name] = file_name
+    self.local.attached_version = self.attached_version
+
+  def attach_database(self, name, file_name):
+    name = str(name)
+    self.attached[name] = str(file_name)
+    self.attached_version += 1
+    self.load_indexes(name)
+    return f"{file_name} attached as {name}"
+
+  def detach_database(self, name):
+    name = str(name)
+    self.attached.pop(name, None)
+    self.attached_version += 1
+    for table_name in [t for t in self.auto_indexes if _split_table(t)[0] == name]:
+      del self.auto_indexes[table_name]
+    self.tables = set([t for t in self.tables if _split_table(t)[0] != name])
+    self.plans = {}
+    self.connection()
+    return f"{name} detached"
+
+  def backup(self, file_name):
+    # copies the main database, a memory session can be kept this way
+    self.flush()
+    target = sqlite3.connect(str(file_name))
+    try:
+      self.connection().backup(target)
+    finally:
+      target.close()
+    return f"saved to {file_name}"
+
+  def close(self):
+    self.flush()
+    for conn in self.connections:
+      conn.close()
+    self.connections = []
+    self.local = threading.local()
+
+  @contextmanager
+  def transaction(self):
+    conn = self.connection()
+    self.local.depth += 1
+    try:
+      yield conn
+    except Exception:
+      self.local.depth -= 1
+      if self.local.depth == 0:
+        conn.rollback()
+      raise
+    self.local.depth -= 1
+    if self.local.depth == 0:
+      conn.commit()
   
-  def execute(self, sql, **kwargs):
-    conn = sqlite3.connect(self.file_name)
-    c = conn.cursor()
-    c.execute(sql, kwargs)
-    conn.commit()
-    conn.close()
+  def execute(self, sql, *args, **kwargs):
+    conn = self.connection()
+    cursor = conn.execute(sql, args if len(args) > 0 else kwargs)
+    if self.local.depth == 0:
+      conn.commit()
+    return cursor
 
   def data_query(self, sql, action=None, **kwargs):
-    conn = sqlite3.connect(self.file_name)
-    conn.row_factory = _dict_factory
-    c = conn.cursor()
-    rows = c.execute(sql, kwargs)
-    for row in rows:
-      if action is not None:
-        yield action(**row)
-      else:
-        yield row
-    c.close()
-    conn.close()
+    c = self.connection().cursor()
+    c.row_factory = _dict_factory
+    try:
+      for row in c.execute(sql, kwargs):
+        if action is not None:
+          yield action(**row)
+        else:
+          yield row
+    finally:
+      c.close()
 
   def class_query(self, cls, **kwargs):
     field_names = [_block_quote(f.split()[0]) for f in cls.fields.split(",")]  
@@ -287,21 +726,24 @@ class LogicDB:
     return self.data_query(f"SELECT {','.join(field_names)} FROM {_block_quote(cls.table_name)} {where}", cls, **kwargs)
 
   def table(self, table_name, field_string):
+    if table_name in self.tables:
+      return
     field_string = ','.join([' '.join([_block_quote(f[0])] + f[1:]) for f in [fg.split() for fg in field_string.split(",")]])
-    cts = f"create table if not exists {_block_quote(table_name)} ({field_string})"
+    cts = f"create table if not exists {_table_quote(table_name)} ({field_string})"
     self.execute(cts)
+    self.tables.add(table_name)
 
   def class_insert(self, cls, **kwargs):
     self.table(cls.table_name, cls.fields)
     field_names = [_block_quote(f) for f in kwargs.keys()]
     field_vars = [_variablize(a) for a in kwargs.keys()]
     sql = f"insert into {cls.table_name} ({','.join(field_names)}) values ({','.join(field_vars)})"
-    return self.execute(sql, **kwargs)
+    return self.execute(sql, **kwargs).lastrowid
 
   def run(self, *lst):
     if isinstance(lst[-1], list):
       r = RuleDefinition.from_list(lst)
-      self.add_rule(r)
+      return self.add_rule(r)
     else:
       f = FactDefinition.from_list(lst)
       if all(map(lambda x: x.argument_type == "CONST", f.arguments)):
@@ -311,26 +753,382 @@ class LogicDB:
       
   def fact_check(self, *args):
     f = FactDefinition.from_list(args)
-    return len(self.query(f)) > 0
+    result = self.query(f)
+    return result.exists() if isinstance(result, ResultSet) else next(iter(result), None) is not None
   
   def find_predicate(self, name, arity):
-    for predicate in self.predicates.values():
-      if predicate.name == name and predicate.arity == arity:
-        return predicate
-    return None
+    return self.predicates.get((name, arity))
 
   def add_fact(self, fact_definition):
     predicate = self.find_predicate(fact_definition.predicate_name, len(fact_definition.arguments))
+    if predicate is not None and len(predicate.fact_hooks) > 0:
+      return predicate.declare(fact_definition.arguments)
     if predicate is None or predicate.table_name is None:
       raise Exception(f"Predicate {fact_definition.predicate_name}/{len(fact_definition.arguments)} not found")
-    sql = predicate.insert([a.value for a in fact_definition.arguments])
-    self.execute(sql)
+    values = tuple([a.value for a in fact_definition.arguments])
+    if self.write_behind:
+      self.defer(predicate, values)
+    else:
+      self.insert_rows(predicate, [values])
+
+  def defer(self, predicate, values):
+    if self.writer is None:
+      self.writer = threading.Thread(target=self.write_pending, daemon=True)
+      self.writer.start()
+    self.pending.put((predicate, values))
+
+  def write_pending(self):
+    # whatever has queued up while the last group committed goes in the next transaction
+    while True:
+      batch = [self.pending.get()]
+      while len(batch) < self.batch_size:
+        try:
+          batch.append(self.pending.get_nowait())
+        except queue.Empty:
+          break
+      try:
+        with self.transaction():
+          for predicate, values in batch:
+            self.insert_rows(predicate, [values])
+      except Exception:
+        # the group rolled back, so its facts are retried one by one to keep the good ones
+        for predicate, values in batch:
+          try:
+            self.insert_rows(predicate, [values])
+          except Exception as e:
+            self.write_error = self.write_error or e
+      for _ in batch:
+        self.pending.task_done()
+
+  def flush(self):
+    self.pending.join()
+    if self.write_error is not None:
+      error, self.write_error = self.write_error, None
+      raise Exception(f"Deferred facts were not written: {error}")
+    return "flushed"
+
+  def bulk_load(self, predicate_name, rows, batch_size=None, progress=None):
+    rows = iter(rows)
+    first = next(rows, None)
+    if first is None:
+      return 0
+    first = tuple(first)
+    predicate = self.find_predicate(predicate_name, len(first))
+    if predicate is None or predicate.table_name is None:
+      raise Exception(f"Predicate {predicate_name}/{len(first)} not found")
+    self.flush()
+    size = int(batch_size if batch_size is not None else self.batch_size)
+    rows = chain([first], rows)
+    count = 0
+    # one transaction for the whole load, executemany per batch
+    with self.transaction():
+      for batch in iter(lambda: [tuple(r) for r in islice(rows, size)], []):
+        self.insert_rows(predicate, batch)
+        count += len(batch)
+        if progress is not None:
+          progress(count)
+    return count
+
+  def insert_rows(self, predicate, rows):
+    with self.transaction() as conn:
+      if not predicate.materialized and len(predicate.change_hooks) == 0 and len(self.maintained_by(predicate)) == 0:
+        conn.executemany(predicate.insert_sql(), rows)
+        return
+      # derived results are updated from the new rows before they are stored
+      rows = [tuple(r) for r in rows]
+      delta = self.delta_table(predicate, rows=rows)
+      later = []
+      self.changed(predicate, delta, 1, later)
+      conn.executemany(predicate.insert_sql(), rows)
+      self.run_later(later)
+      self.drop_delta(delta)
+
+  def retract(self, *args):
+    self.flush()
+    f = FactDefinition.from_list(args)
+    predicate = self.query_predicate(f)
+    if predicate.table_name is None:
+      raise Exception(f"Predicate {predicate.name}/{predicate.arity} is not a table")
+    where = predicate.filter(f.arguments)
+    where = "" if where == "" else f" where {where}"
+    parameters = dict([(f"a{x.argument_number}", x.value) for x in f.arguments if x.argument_type == 'CONST'])
+    fields = ', '.join([_block_quote(p.field_name) for p in predicate.ordered_parts()])
+    with self.transaction():
+      delta = self.delta_table(predicate, f"select {fields}, 1 from {_table_quote(predicate.table_name)}{where}", **parameters)
+      removed = self.execute(f"delete from {_table_quote(predicate.table_name)}{where}", **parameters).rowcount
+      later = []
+      self.changed(predicate, delta, -1, later)
+      self.run_later(later)
+      self.drop_delta(delta)
+    return f"{removed} facts retracted"
+
+  def materialize(self, name, arity):
+    predicate = self.find_predicate(str(name), int(arity))
+    if predicate is None or len(predicate.rules) == 0:
+      raise Exception(f"Predicate {name}/{arity} has no rules")
+    if not predicate.materialized:
+      fields = ', '.join([_block_quote(p.field_name) for p in predicate.ordered_parts()])
+      with self.transaction():
+        self.execute(f"create table if not exists {_block_quote(predicate.materialized_name())} ({fields}, [_count_] INTEGER)")
+        self.execute(f"create unique index if not exists {_block_quote(predicate.materialized_name() + '_key')} on {_block_quote(predicate.materialized_name())} ({fields})")
+        predicate.materialized = True
+        self.materialized[predicate.id] = predicate
+        self.compile_rules(predicate)
+    return f"{predicate.name}/{predicate.arity} is materialized"
+
+  def load_materialized(self):
+    names = dict([(p.materialized_name(), p) for p in self.predicates.values() if len(p.rules) > 0])
+    for row in list(self.data_query("select name from sqlite_master where type = 'table' and name like 'tau_mat_%'")):
+      if row["name"] in names:
+        names[row["name"]].materialized = True
+        self.materialized[names[row["name"]].id] = names[row["name"]]
+
+  def maintained_by(self, predicate):
+    # materialized predicates that read this one, directly or through views
+    return [d for d in list(self.materialized.values()) if d is not predicate and d.reads(predicate)]
+
+  def delta_table(self, predicate, sql=None, rows=None, **parameters):
+    # changed rows, or derivation counts, of a predicate live in temp tables
+    name = f"tau_delta_{next(self.delta_numbers)}"
+    fields = [_block_quote(p.field_name) for p in predicate.ordered_parts()]
+    self.execute(f"create temp table {_block_quote(name)} ({', '.join(fields)}, [_count_] INTEGER)")
+    if rows is not None:
+      self.connection().executemany(f"insert into temp.{_block_quote(name)} values ({', '.join(['?'] * len(fields))}, 1)", rows)
+    else:
+      self.execute(f"insert into temp.{_block_quote(name)} {sql}", **parameters)
+    return f"temp.{_block_quote(name)}"
+
+  def drop_delta(self, delta):
+    self.execute(f"drop table if exists {delta}")
+
+  def run_later(self, later):
+    # work that has to see the stored rows, it can queue more of its own
+    index = 0
+    while index < len(later):
+      later[index]()
+      index += 1
+
+  def changed(self, predicate, delta, sign, later):
+    if predicate.materialized:
+      fields = ', '.join([_block_quote(p.field_name) for p in predicate.ordered_parts()])
+      self.apply_counts(predicate, self.delta_table(predicate, f"select {fields}, count(*) from {delta} group by {fields}"), sign, later)
+    else:
+      self.propagate(predicate, delta, sign, later)
+
+  def propagate(self, predicate, delta, sign, later):
+    # inserted rows are passed on before they are stored, deleted rows after they are gone
+    if len(predicate.change_hooks) > 0:
+      fields = ', '.join([_block_quote(p.field_name) for p in predicate.ordered_parts()])
+      rows = list(self.data_query(f"select {fields} from {delta}"))
+      for hook in predicate.change_hooks:
+        hook(predicate, rows, sign)
+    for derived in self.maintained_by(predicate):
+      if derived.reads_through_views(predicate) or (sign < 0 and derived.is_recursive()):
+        if sign > 0:
+          later.append(lambda derived=derived: self.refresh(derived, later))
+        else:
+          self.refresh(derived, later)
+        continue
+      fields = ', '.join([_block_quote(p.field_name) for p in derived.ordered_parts()])
+      sqls = [sql for rule in derived.rules for sql in rule.delta_sql(predicate, delta)]
+      counts = self.delta_table(derived, f"select {fields}, count(*) from ({' union all '.join(sqls)}) group by {fields}")
+      self.apply_counts(derived, counts, sign, later)
+
+  def apply_counts(self, derived, counts, sign, later):
+    # counting: each derived row keeps the number of ways it can be derived
+    if derived.is_recursive():
+      if sign > 0:
+        later.append(lambda: self.insert_closure(derived, counts, later))
+      else:
+        self.drop_delta(counts)
+        self.refresh(derived, later)
+      return
+    names = [_block_quote(p.field_name) for p in derived.ordered_parts()]
+    fields = ', '.join(names)
+    table = _block_quote(derived.materialized_name())
+    match = ' and '.join([f"M.{n} = C.{n}" for n in names])
+    if sign > 0:
+      added = self.delta_table(derived, f"select {', '.join([f'C.{n}' for n in names])}, 1 from {counts} as C where not exists (select 1 from {table} as M where {match})")
+      self.propagate(derived, added, 1, later)
+      self.drop_delta(added)
+    else:
+      removed = self.delta_table(derived, f"select {', '.join([f'C.{n}' for n in names])}, 1 from {counts} as C, {table} as M where {match} and M.[_count_] <= C.[_count_]")
+    self.execute(f"insert into {table} ({fields}, [_count_]) select {fields}, {sign} * [_count_] from {counts} where true on conflict ({fields}) do update set [_count_] = [_count_] + excluded.[_count_]")
+    self.execute(f"delete from {table} where [_count_] <= 0")
+    if sign < 0:
+      self.propagate(derived, removed, -1, later)
+      self.drop_delta(removed)
+    self.drop_delta(counts)
+
+  def insert_closure(self, derived, counts, later):
+    # semi-naive: only the rows new in the last round are joined again
+    names = [_block_quote(p.field_name) for p in derived.ordered_parts()]
+    fields = ', '.join(names)
+    table = _block_quote(derived.materialized_name())
+    match = ' and '.join([f"M.{n} = S.{n}" for n in names])
+    source = counts
+    while True:
+      added = self.delta_table(derived, f"select distinct {', '.join([f'S.{n}' for n in names])}, 1 from {source} as S where not exists (select 1 from {table} as M where {match})")
+      self.drop_delta(source)
+      if not self.connection().execute(f"select exists (select 1 from {added})").fetchone()[0]:
+        self.drop_delta(added)
+        return
+      self.propagate(derived, added, 1, later)
+      self.execute(f"insert into {table} ({fields}, [_count_]) select {fields}, 1 from {added}")
+      steps = [sql for rule in derived.rules if rule.is_recursive() for sql in rule.delta_sql(derived, added)]
+      source = self.delta_table(derived, f"select {fields}, 1 from ({' union '.join(steps)})")
+      self.drop_delta(added)
+
+  def refresh(self, derived, later):
+    # full recompute, the difference to the stored rows is passed on
+    names = [_block_quote(p.field_name) for p in derived.ordered_parts()]
+    fields = ', '.join(names)
+    table = _block_quote(derived.materialized_name())
+    full = derived.rules_sql() if derived.is_recursive() else ' union all '.join(derived.base_sql())
+    fresh = self.delta_table(derived, f"select {fields}, count(*) from ({full}) group by {fields}")
+    added = self.delta_table(derived, f"select {', '.join([f'F.{n}' for n in names])}, 1 from {fresh} as F where not exists (select 1 from {table} as M where {' and '.join([f'M.{n} = F.{n}' for n in names])})")
+    removed = self.delta_table(derived, f"select {', '.join([f'M.{n}' for n in names])}, 1 from {table} as M where not exists (select 1 from {fresh} as F where {' and '.join([f'M.{n} = F.{n}' for n in names])})")
+    self.propagate(derived, added, 1, later)
+    self.execute(f"delete from {table}")
+    self.execute(f"insert into {table} ({fields}, [_count_]) select {fields}, [_count_] from {fresh}")
+    self.propagate(derived, removed, -1, later)
+    for delta in [fresh, added, removed]:
+      self.drop_delta(delta)
+
+  def load_csv(self, predicate_name, file_name, batch_size=None, progress=None, header=False):
+    with open(file_name, newline="") as f:
+      rows = csv.reader(f)
+      if header:
+        next(rows, None)
+      return self.bulk_load(predicate_name, rows, batch_size, progress)
+
+  def load_jsonl(self, predicate_name, file_name, batch_size=None, progress=None):
+    def rows(f):
+      fields = None
+      for line in f:
+        if line.strip() == "":
+          continue
+        row = json.loads(line)
+        if isinstance(row, dict):
+          # objects are matched to the predicate's fields by name
+          if fields is None:
+            predicate = self.find_predicate(predicate_name, len(row))
+            if predicate is None:
+              raise Exception(f"Predicate {predicate_name}/{len(row)} not found")
+            fields = [p.field_name for p in sorted(predicate.parts, key=lambda p: p.seq)]
+          row = [row[field] for field in fields]
+        yield row
+    with open(file_name) as f:
+      return self.bulk_load(predicate_name, rows(f), batch_size, progress)
+
+  def load_facts(self, predicate_name, source, batch_size=None, progress=None):
+    if isinstance(source, str) and source.endswith(".csv"):
+      return self.load_csv(predicate_name, source, batch_size, progress)
+    if isinstance(source, str) and (source.endswith(".jsonl") or source.endswith(".json")):
+      return self.load_jsonl(predicate_name, source, batch_size, progress)
+    return self.bulk_load(predicate_name, source, batch_size, progress)
 
   def add_rule(self, rule_definition):
     predicate = self.find_predicate(rule_definition.predicate_name, len(rule_definition.arguments))
     if predicate is None:
-      raise Exception(f"Predicate {rule_definition.predicate_name}/{len(rule_definition.arguments)} not found")
-    raise Exception("Not implemented")
+      predicate = self.create_rule_predicate(rule_definition.predicate_name, len(rule_definition.arguments))
+    query_predicates = []
+    for fact_definition in rule_definition.queries:
+      query_predicate = self.find_predicate(fact_definition.predicate_name, len(fact_definition.arguments))
+      if query_predicate is None:
+        raise Exception(f"Predicate {fact_definition.predicate_name}/{len(fact_definition.arguments)} not found")
+      if query_predicate.query_hook is not None:
+        raise Exception(f"Predicate {query_predicate.name}/{query_predicate.arity} is custom and cannot be used in rules")
+      query_predicates.append(query_predicate)
+    for query_predicate in query_predicates:
+      # recursion is compiled per predicate, a cycle through another predicate would make circular views
+      if query_predicate is not predicate and query_predicate.depends_on(predicate):
+        raise Exception(f"Rule for {predicate.name}/{predicate.arity} is recursive through {query_predicate.name}/{query_predicate.arity}, only direct recursion is supported")
+    rule = None
+    try:
+      with self.transaction():
+        rule = Rule(self.class_insert(Rule, predicate_id=predicate.id), predicate.id)
+        rule.attach(self)
+        for argument in rule_definition.arguments:
+          self.attach_new(RuleArgument, rule_id=rule.id, seq=argument.argument_number, argument=argument.value, argument_type=argument.argument_type)
+        for seq, (fact_definition, query_predicate) in enumerate(zip(rule_definition.queries, query_predicates)):
+          query = self.attach_new(Query, rule_id=rule.id, seq=seq, predicate_id=query_predicate.id)
+          for argument in fact_definition.arguments:
+            self.attach_new(QueryArgument, query_id=query.id, seq=argument.argument_number, argument=argument.value, argument_type=argument.argument_type)
+        self.compile_rules(predicate)
+    except Exception:
+      if rule is not None:
+        self.detach_rule(rule)
+      raise
+    return f"{predicate.name}/{predicate.arity} has {len(predicate.rules)} rules"
+
+  def attach_new(self, cls, **kwargs):
+    item = cls(self.class_insert(cls, **kwargs), **kwargs)
+    item.attach(self)
+    return item
+
+  def detach_rule(self, rule):
+    self.plans = {}
+    rule.predicate.rules.remove(rule)
+    for query in rule.queries:
+      query.predicate.queries.remove(query)
+      for argument in query.arguments:
+        self.data[QueryArgument.table_name].pop(argument.id, None)
+      self.data[Query.table_name].pop(query.id, None)
+    for argument in rule.arguments:
+      self.data[RuleArgument.table_name].pop(argument.id, None)
+    self.data[Rule.table_name].pop(rule.id, None)
+
+  def create_rule_predicate(self, name, arity):
+    # a predicate defined only by rules has no table, just its view
+    self.class_insert(Predicate, name=name, arity=arity, table_name=None)
+    predicate = list(self.class_query(Predicate, name=name, arity=arity))[0]
+    predicate.attach(self)
+    for i in range(arity):
+      self.attach_new(PredicatePart, predicate_id=predicate.id, seq=i, field_name=f"arg{i}", field_type="")
+    return predicate
+
+  def compile_rules(self, predicate):
+    # the predicate and everything built on it are recompiled, dependencies first
+    self.plans = {}
+    pending = [predicate]
+    seen = []
+    while len(pending) > 0:
+      current = pending.pop(0)
+      if current in seen:
+        continue
+      seen.append(current)
+      pending += [q.rule.predicate for q in current.queries if q.rule.predicate is not current]
+    for current in seen:
+      self.compile_view(current)
+    later = []
+    for current in seen:
+      if current.materialized:
+        self.refresh(current, later)
+    self.run_later(later)
+
+  def compile_view(self, predicate):
+    for rule in predicate.rules:
+      shared = rule.shared_variables()
+      for query in rule.queries:
+        if query.predicate is not predicate:
+          self.ensure_index(query.predicate, [query.predicate.part_name(a.argument_number) for a in query.arguments if a.argument_type != "VAR" or a.value in shared])
+    self.execute(f"drop view if exists {_block_quote(predicate.view_name())}")
+    if predicate.spans_databases():
+      predicate.rules_sql()
+    else:
+      self.execute(f"create view {_block_quote(predicate.view_name())} as {predicate.rules_sql()}")
+
+  def ensure_index(self, predicate, fields):
+    # fields a rule joins on or a specialised query binds are indexed straight away
+    if len(fields) == 0 or predicate.table_name is None or len(predicate.rules) > 0:
+      return None
+    bound = set(fields)
+    pattern = tuple([p.field_name for p in predicate.ordered_parts() if p.field_name in bound])
+    index = self.index_for(predicate.table_name, pattern)
+    if index is None:
+      index = self.create_index(predicate, pattern)
+    return index
   
   def create_predicate(self, name, table_name, field_string): 
     if isinstance(field_string, list):
@@ -338,56 +1136,90 @@ class LogicDB:
     
     arity = len(field_string.split(","))
     self.table(table_name, field_string)
-    self.class_insert(Predicate, name=name, arity=arity, table_name=table_name)
-    predicate = list(self.class_query(Predicate, name=name, arity=arity))[0]
+    predicate = self.find_predicate(name, arity)
+    if predicate is not None and len(predicate.parts) == arity:
+      return predicate
+    # an existing predicate is reused so its metadata rows are only written once
+    existing = list(self.class_query(Predicate, name=name, arity=arity))
+    if len(existing) == 0:
+      self.class_insert(Predicate, name=name, arity=arity, table_name=table_name)
+      existing = list(self.class_query(Predicate, name=name, arity=arity))
+    predicate = existing[0]
     predicate.attach(self)
-  
-    for i, ft in enumerate(field_string.split(",")):
-      f = ft.split()
-      self.class_insert(PredicatePart, 
-                      predicate_id=predicate.id,
-                      seq=i,
-                      field_name=f[0],
-                      field_type=' '.join(f[1:]))
-    
-    predicate_parts = self.class_query(PredicatePart, predicate_id=predicate.id)
+
+    self.table(PredicatePart.table_name, PredicatePart.fields)
+    predicate_parts = list(self.class_query(PredicatePart, predicate_id=predicate.id))
+    if len(predicate_parts) == 0:
+      for i, ft in enumerate(field_string.split(",")):
+        f = ft.split()
+        self.class_insert(PredicatePart, 
+                        predicate_id=predicate.id,
+                        seq=i,
+                        field_name=f[0],
+                        field_type=' '.join(f[1:]))
+      predicate_parts = list(self.class_query(PredicatePart, predicate_id=predicate.id))
     for predicate_part in predicate_parts:
       predicate_part.attach(self)
+    return predicate
  
   def attach(self, item):
     if not type(item).table_name in self.data.keys():
       self.data[type(item).table_name] = {}
     item.db = self
     self.data[type(item).table_name][item.id] = item
+    if isinstance(item, Predicate):
+      replaced = self.predicates.get((item.name, item.arity))
+      named = self.predicates_by_name.setdefault(item.name, [])
+      if replaced is not None and replaced in named:
+        named.remove(replaced)
+      named.append(item)
+      self.predicates[(item.name, item.arity)] = item
+    elif isinstance(item, Link):
+      self.links[(item.local_part_id, item.remote_part_id)] = item
 
   def _new_id(self, type_name):
-    new_id = self._new_id.get(type_name, -1)
-    new_id = new_id - 1
-    self._new_id[type_name] = new_id
+    # custom predicates are not stored, negative ids keep them apart from table rows
+    new_id = self._new_id_dict.get(type_name, 0) - 1
+    self._new_id_dict[type_name] = new_id
     return new_id
 
   def register(self, custom: CustomPredicate):
-    predicate = Predicate(custom.predicate_name, custom.arity, None)
+    predicate = Predicate(self._new_id(Predicate.table_name), custom.predicate_name, custom.arity, None)
     predicate.query_hook = custom.query_hook
     predicate.fact_hooks = custom.fact_hooks
-    predicate.predicate_id = self._new_id("predicate")
     predicate.attach(self)
-    self.predicates[predicate.predicate_id] = predicate
     for i, argument in enumerate(custom.arguments):
-      part = PredicatePart(self._new_id("predicate_part"), predicate.predicate_id, i, argument)
-      part.attach(self)
-      self.predicate_parts[part.predicate_part_id] = part
+      PredicatePart(self._new_id(PredicatePart.table_name), predicate.id, i, argument, "").attach(self)
     return predicate
 
   def query(self, fact_definition):
     # there should be a _result_number_ for each row so that. 
     # when there are no variables there is still a response.
+    return self.query_predicate(fact_definition).query(fact_definition.arguments)
 
+  def query_predicate(self, fact_definition):
     predicate = self.find_predicate(fact_definition.predicate_name, len(fact_definition.arguments))
     if predicate is None:
       raise Exception(f"Predicate {fact_definition.predicate_name}/{len(fact_definition.arguments)} not found")
-    sql = predicate.query(fact_definition.arguments)
-    return self.data_query(sql)
+    return predicate
+
+  def plan(self, predicate, argument_definitions):
+    # sql is built once per binding pattern, the constants are passed as parameters
+    key = (predicate.id, tuple([x.value if x.argument_type == 'VAR' else None for x in argument_definitions]))
+    sql = self.plans.get(key)
+    if sql is None:
+      sql = self.plans[key] = predicate.query_sql(argument_definitions)
+    return sql, dict([(f"a{x.argument_number}", x.value) for x in argument_definitions if x.argument_type == 'CONST'])
+
+  def explain(self, *args):
+    f = FactDefinition.from_list(args)
+    sql, parameters = self.plan(self.query_predicate(f), f.arguments)
+    lines = [sql]
+    depth = {0: 0}
+    for row in self.data_query(f"explain query plan {sql}", **parameters):
+      depth[row["id"]] = depth.get(row["parent"], 0) + 1
+      lines.append("  " * depth[row["id"]] + row["detail"])
+    return "\n".join(lines)
     
   def create(self):
     for cls in classes:
@@ -397,31 +1229,128 @@ class LogicDB:
     for cls in classes:
       for row in self.class_query(cls):
         row.attach(self)
+    self.load_indexes()
+    self.load_materialized()
+
+  def load_indexes(self, schema=None):
+    # indexes made in earlier sessions, their hit counts start over
+    prefix = "" if schema is None else f"{_block_quote(schema)}."
+    rows = list(self.data_query(f"select name, tbl_name from {prefix}sqlite_master where type = 'index' and name like 'tau_ix_%'"))
+    for row in rows:
+      table_name = row["tbl_name"] if schema is None else f"{schema}.{row['tbl_name']}"
+      name = row["name"] if schema is None else f"{schema}.{row['name']}"
+      columns = [c["name"] for c in self.data_query(f"pragma {prefix}index_info({_block_quote(row['name'])})")]
+      self.auto_indexes.setdefault(table_name, {})[name] = {"name": name, "table": table_name, "columns": columns, "hits": 0}
+
+  def record_usage(self, predicate, fields):
+    if len(fields) == 0 or predicate.table_name is None or len(predicate.rules) > 0:
+      return
+    bound = set(fields)
+    pattern = tuple([p.field_name for p in predicate.ordered_parts() if p.field_name in bound])
+    key = (predicate.table_name, pattern)
+    self.index_usage[key] = self.index_usage.get(key, 0) + 1
+    index = self.index_for(predicate.table_name, pattern)
+    if index is not None:
+      index["hits"] += 1
+    elif self.index_usage[key] >= self.index_after:
+      self.create_index(predicate, pattern)
+
+  def index_for(self, table_name, pattern):
+    # an index serves a pattern when the pattern is its leading columns
+    for index in self.auto_indexes.get(table_name, {}).values():
+      if set(index["columns"][:len(pattern)]) == set(pattern):
+        return index
+    return None
+
+  def create_index(self, predicate, pattern):
+    table_name = predicate.table_name
+    indexes = self.auto_indexes.setdefault(table_name, {})
+    hits = self.index_usage.get((table_name, pattern), 0)
+    if len(indexes) >= self.max_indexes:
+      weakest = min(indexes.values(), key=lambda i: i["hits"])
+      if weakest["hits"] >= hits:
+        return None
+      self.drop_index(weakest["name"])
+    # the remaining fields follow the bound ones so the index covers the query
+    columns = list(pattern) + [p.field_name for p in predicate.ordered_parts() if p.field_name not in pattern]
+    # an index lives in its table's database and names the table without the schema
+    schema, table = _split_table(table_name)
+    name = f"tau_ix_{table}_{'_'.join(pattern)}" if schema is None else f"{schema}.tau_ix_{table}_{'_'.join(pattern)}"
+    self.execute(f"create index if not exists {_table_quote(name)} on {_block_quote(table)} ({', '.join([_block_quote(c) for c in columns])})")
+    indexes[name] = {"name": name, "table": table_name, "columns": columns, "hits": hits}
+    return indexes[name]
+
+  def drop_index(self, name):
+    for indexes in self.auto_indexes.values():
+      if name in indexes:
+        del indexes[name]
+    self.execute(f"drop index if exists {_table_quote(name)}")
+
+  def index_report(self, *args):
+    lines = []
+    for table_name, indexes in self.auto_indexes.items():
+      for index in sorted(indexes.values(), key=lambda i: -i["hits"]):
+        lines.append(f"{index['name']} on {table_name}({', '.join(index['columns'])}) hits {index['hits']}")
+    return "\n".join(lines)
+
+  def find_part(self, endpoint):
+    # endpoints are parts or predicate.field names
+    if isinstance(endpoint, PredicatePart):
+      return endpoint
+    name, field_name = str(endpoint).rsplit(".", 1)
+    parts = [p.find_part(field_name) for p in self.predicates_by_name.get(name, [])]
+    parts = [p for p in parts if p is not None]
+    if len(parts) != 1:
+      raise Exception(f"Part {endpoint} not found" if len(parts) == 0 else f"Part {endpoint} is ambiguous")
+    return parts[0]
+
+  def create_link(self, name, *local_and_remotes):
+    created = 0
+    with self.transaction():
+      for local, remote in local_and_remotes:
+        local = self.find_part(local)
+        remote = self.find_part(remote)
+        # this will also need to make or modify the foreign key
+        if (local.id, remote.id) not in self.links:
+          self.attach_new(Link, link_name=str(name), local_part_id=local.id, remote_part_id=remote.id)
+          created += 1
+    return f"{name} links {created} parts"
+
+def report_progress(count):
+  sys.stderr.write(f"\r{count} facts")
+  sys.stderr.flush()
 
-  def create_link(self, name, local_and_remotes):
-    for index, pair in enumerate(local_and_remotes):
-      local, remote = pair
-      # this will also need to make or modify the foreign key
-      self.execute("""insert into link (link_name, local_part_id, remote_part_id)
-                      select l.id, r.id
-                      from predicate_part l, predicate_part r
-                      where l.predicate_id = :local_predicate_id
-                      and l.seq = :local_seq
-                      and r.predicate_id = :remote_predicate_id
-                      and r.seq = :remote_seq
-                      """,
-                      **{"local_predicate_id":local.predicate_id
-                        ,"local_seq":local.seq
-                        ,"remote_predicate_id":remote.predicate_id
-                        ,"remote_seq":remote.seq
-                        })
+@streams
+def facts(input, predicate_name, separator=None):
+  # each piped line becomes one fact, split into fields on the separator
+  lines = input.splitlines() if isinstance(input, str) else input
+  rows = (str(line).split(separator) for line in lines if str(line) != "")
+  count = _instance_["ldb"].bulk_load(str(predicate_name), rows, progress=report_progress)
+  sys.stderr.write("\n")
+  return f"{count} facts loaded"
 
 def on_load(instance):
-  instance["ldb"] = LogicDB("logic.db")
+  global _instance_
+  _instance_ = instance
+  settings = instance.get("logicdb", {})
+  instance["ldb"] = LogicDB(settings.get("file", "logic.db"), write_behind=settings.get("write_behind", False))
+  for name, file_name in settings.get("attach", {}).items():
+    instance["ldb"].attach_database(name, file_name)
   instance["lisp"] = instance["lisp"] | {
-    "!": lambda *args: instance["ldb"].run(list(args)),
-    "?": lambda *args: instance["ldb"].fact_check(list(args)),
+    "!": lambda *args: instance["ldb"].run(*args),
+    "?": lambda *args: instance["ldb"].fact_check(*args),
     "predicate": lambda *args: instance["ldb"].create_predicate(*args),
     "link": lambda *args: instance["ldb"].create_link(*args),
+    "indexes": lambda *args: instance["ldb"].index_report(*args),
+    "explain": lambda *args: instance["ldb"].explain(*args),
+    "attach": lambda name, file_name: instance["ldb"].attach_database(name, file_name),
+    "detach": lambda name: instance["ldb"].detach_database(name),
+    "backup": lambda file_name: instance["ldb"].backup(file_name),
+    "flush": lambda: instance["ldb"].flush(),
+    "retract": lambda *args: instance["ldb"].retract(*args),
+    "materialize": lambda name, arity: instance["ldb"].materialize(name, arity),
+    "first": lambda result: result.first() if isinstance(result, ResultSet) else next(iter(result), None),
+    "page": lambda result, count, offset=0: result.page(count, offset) if isinstance(result, ResultSet) else list(islice(result, int(offset), int(offset) + int(count))),
+    "bulk": lambda name, source, *args: instance["ldb"].load_facts(name, source, *args, progress=report_progress),
   }
 
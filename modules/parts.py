@@ -1,6 +1,7 @@
 from tokenizer import Tokenizer
-from util import get_command, get_object, coalesce, cmd, evaluate, dowith
+from util import get_command, get_object, coalesce, cmd, cmd_stream, evaluate, invalidate_statements, _scope_, index_modules, Stream, Quoted
 import re
+from types import ModuleType
 
 _environ_ = {}
 
@@ -14,12 +15,18 @@ class CommandPart:
   
   def __call__(self, *args):
     return self.text
+
+  def accepts_stream(self):
+    return False
   
   #def __call__(self, *args):
   #  return coalesce(self.data, self.command, self.name)
   
   def set_value(self, value):
-    _environ_[self.text] = value
+    if self.text not in _scope_:
+      # a new name changes how words classify as variables
+      invalidate_statements()
+    _scope_[self.text] = value
 
   @classmethod
   def add_word_type(cls, t):
@@ -63,6 +70,9 @@ class Access(CallablePart):
       else:
         print (f"Error: {str(current)} does not have attribute {step}")
     setattr(current, str(self.chain[-1]), value)
+    if isinstance(current, ModuleType):
+      index_modules()
+      invalidate_statements()
 
   @classmethod
   def is_acceptable_input(cls, inp):
@@ -102,15 +112,15 @@ class Variable(CommandPart):
     super().__init__(text)
   
   def __str__(self):
-    return _environ_.get(self.text, self.text)
+    return _scope_.get(self.text, self.text)
   
   def __call__(self):
-    return _environ_[self.text]
+    return _scope_[self.text]
   
   @classmethod
   def is_acceptable_input(self, text):
     if isinstance(text, str):
-      return text.startswith("@") or text in _environ_.keys()
+      return text.startswith("@") or text in _scope_
     elif isinstance(text, Variable):
       return True
   
@@ -121,6 +131,9 @@ class CommandReference(CallablePart):
     super().__init__(text)
     self.command = get_command(text)
   
+  def accepts_stream(self):
+    return getattr(self.command, "streams", False)
+
   def __call__(self, *args):
     try:
       if callable(self.command):
@@ -166,7 +179,7 @@ class ExternalCommand(CommandPart):
     super().__init__(text)
 
   def __call__(self, *args):
-    return cmd(*[self.text] + [str(arg) for arg in args])
+    return cmd_stream([[self.text] + [arg if isinstance(arg, str) else str(arg) for arg in args]])
 
   def __str__(self):
     return self.text
@@ -185,7 +198,7 @@ class String(CommandPart):
     super().__init__(s)
 
   def __str__(self):
-    return self.text
+    return Quoted(self.text)
 
 class Interpolation(CommandPart):
   def __init__(self, s):
@@ -206,17 +219,23 @@ class ShellStatement:
   def inject_argument(self, argument):
     self.arguments = [argument] + self.arguments
 
+  def accepts_stream(self):
+    return False
+
   @classmethod
   def add_binary(cls, char, fcls):
     _environ_["statement"]["binaries"].append((char, fcls))
+    invalidate_statements()
   
   @classmethod
   def add_segment(cls, open_char, close_char, fact):
     _environ_["statement"]["segments"].append((open_char, close_char, fact))
+    invalidate_statements()
 
   @classmethod
   def add_prefix(cls, char, count, fact):
     _environ_["statement"]["prefixes"].append((char, count, fact))
+    invalidate_statements()
 
   @classmethod
   def tokenize(cls, s):
@@ -248,19 +267,81 @@ class ShellCall(ShellStatement):
     else:
       return ExternalCommand(self.head().text)
 
+  def is_external(self):
+    return not isinstance(self.head(), CallablePart)
+
+  def accepts_stream(self):
+    if isinstance(self.head(), Access):
+      return getattr(self.head()(), "streams", False)
+    return self.callable_head().accepts_stream()
+
   def __call__(self, *args):
-    return self.callable_head()(*self.tail())
+    return self.callable_head()(*([a if isinstance(a, Stream) else str(a) for a in args] + self.tail()))
 
 class Pipe(ShellStatement):
   def __init__(self, *statements: [ShellStatement]):
-    self.statements = statements
+    # a | b | c arrives as Pipe(a, Pipe(b, c)), it is flattened once, on first use, so long pipes build in linear time
+    self.parts = statements
+    self.flat = None
+    self.grouped = None
+
+  @property
+  def statements(self):
+    if self.flat is None:
+      flat = []
+      pending = list(reversed(self.parts))
+      while len(pending) > 0:
+        statement = pending.pop()
+        if isinstance(statement, Pipe):
+          pending.extend(reversed(statement.parts))
+        elif isinstance(statement, CommandPart):
+          flat.append(ShellCall(statement))
+        else:
+          flat.append(statement)
+      self.flat = tuple(flat)
+    return self.flat
+
+  @property
+  def stages(self):
+    # runs of external commands are connected stdout to stdin by the os
+    if self.grouped is None:
+      stages = []
+      external = False
+      for statement in self.statements:
+        if isinstance(statement, ShellCall) and statement.is_external():
+          if external and isinstance(stages[-1], ExternalPipe):
+            stages[-1].calls.append(statement)
+            continue
+          if external:
+            stages[-1] = ExternalPipe(stages[-1], statement)
+            continue
+          external = True
+        else:
+          external = False
+        stages.append(statement)
+      self.grouped = stages
+    return self.grouped
   
   def __call__(self, *args: [CommandPart]):
-    index = 0
-    while index < (len(self.statements) - 1):
-      self.statements[index + 1].inject_argument(self.statements[index]())
-      index += 1
-    return self.statements[-1]()
+    stages = self.stages
+    value = stages[0](*args)
+    for statement in stages[1:]:
+      if isinstance(value, Stream) and not (_environ_.get("stream_pipes", True) and statement.accepts_stream()):
+        value = str(value)
+      value = statement(value)
+    return value
+
+class ExternalPipe(ShellStatement):
+  def __init__(self, *calls: [ShellCall]):
+    self.calls = list(calls)
+
+  def __str__(self):
+    return " | ".join([str(c) for c in self.calls])
+
+  def __call__(self, *args):
+    first = [self.calls[0].head().text] + [str(a) for a in args] + self.calls[0].tail()
+    rest = [[c.head().text] + c.tail() for c in self.calls[1:]]
+    return cmd_stream([first] + rest)
 
 class Set(ShellStatement):
   def __init__(self, left, right):
@@ -271,18 +352,33 @@ class Set(ShellStatement):
     self.right = str(argument)
   
   def __call__(self, *args):
+    if len(args) > 0:
+      return self.left.set_value(str(args[0]))
     return self.left.set_value(str(self.right))
   
 class Lambda(CallablePart):
   def __init__(self, name, interior_part):
-    super().__init__(name)
+    super().__init__(name.text if isinstance(name, CommandPart) else str(name))
     self.interior_part = interior_part
+    # frames are reused between calls, a call made while another is running takes a fresh one
+    self.frames = []
     
   def __call__(self, *args):
-    return dowith(self.interior_part, **{self.name:args[0]()})
+    value = args[0] if len(args) > 0 else None
+    if isinstance(value, CommandPart):
+      value = value()
+    frame = self.frames.pop() if len(self.frames) > 0 else {}
+    frame[self.text] = value
+    _scope_.push(frame)
+    try:
+      return self.interior_part()
+    finally:
+      _scope_.pop()
+      frame.clear()
+      self.frames.append(frame)
  
   def __str__(self):
-    return f"lambda ({','.join([str(a) for a in self.arguments])}): {str(self.body)}"
+    return f"\\{self.text} {str(self.interior_part)}"
 
 def on_load(data):
   global _environ_
@@ -295,4 +391,5 @@ def on_load(data):
   _environ_["statement"]["segments"].append(("'", "'", String))
   _environ_["statement"]["segments"].append(('"', '"', String))
   _environ_["statement"]["segments"].append(("{", "}", Interpolation))
+  invalidate_statements()
   
\ No newline at end of file
@@ -1,11 +1,12 @@
 import os
 import shutil
 import re
+from util import Stream, streams
 
 def ls(*a):
   if len(a) > 0:
-    return lines(os.listdir(str(a[0])))
-  return lines(os.listdir())
+    return lines(entry.name for entry in os.scandir(str(a[0])))
+  return lines(entry.name for entry in os.scandir())
 
 
 def cd(*a):
@@ -40,21 +41,19 @@ def exp(*a):
   return os.system(f"explorer {''.join([str(i) for i in a])}")
 
 
+@streams
 def where(input, pattern):
-  patter = str(pattern)
-  rtns = []
-  if isinstance(input, list):
-    for i in input:
-      if re.search(pattern, i) is not None:
-        rtns.append(i)
-  else:
-    if re.search(pattern, input) is not None:
-      rtns.append(input)
-  return rtns
+  pattern = re.compile(str(pattern))
+  if isinstance(input, str):
+    input = input.splitlines()
+  return Stream(i for i in input if pattern.search(str(i)) is not None)
 
 
+@streams
 def lines(items):
-  return '\n'.join(items)
+  if isinstance(items, str):
+    items = items.splitlines()
+  return Stream(str(i) for i in items)
 
 
 def echo(*a):
@@ -1,10 +1,58 @@
-class ProxyDict(dict):
-  def __init__(self, original, *args, **kwargs):
-    super().__init__(*args, **kwargs)
-    self.__dict__ = dict(**kwargs)
-    self.original = original
-  
-  def __getattr__(self, name):
-    return self.get(name, self.original[name])
-
-  
\ No newline at end of file
+import threading
+
+_missing_ = object()
+
+class Scope:
+  # frames chained over a base dictionary, the innermost binding wins and writes stay in the innermost frame
+  def __init__(self, base):
+    self.base = base
+    self.local = threading.local()
+
+  def frames(self):
+    frames = getattr(self.local, "frames", None)
+    if frames is None:
+      frames = self.local.frames = []
+    return frames
+
+  def push(self, frame):
+    self.frames().append(frame)
+    return frame
+
+  def pop(self):
+    return self.frames().pop()
+
+  def depth(self):
+    return len(self.frames())
+
+  def find(self, key, default=None):
+    # only the pushed frames, not the base
+    for frame in reversed(self.frames()):
+      value = frame.get(key, _missing_)
+      if value is not _missing_:
+        return value
+    return default
+
+  def get(self, key, default=None):
+    value = self.find(key, _missing_)
+    if value is _missing_:
+      return self.base.get(key, default)
+    return value
+
+  def __getitem__(self, key):
+    value = self.find(key, _missing_)
+    if value is _missing_:
+      return self.base[key]
+    return value
+
+  def __setitem__(self, key, value):
+    frames = self.frames()
+    (frames[-1] if len(frames) > 0 else self.base)[key] = value
+
+  def __contains__(self, key):
+    return any(key in frame for frame in self.frames()) or key in self.base
+
+  def keys(self):
+    keys = set(self.base.keys())
+    for frame in self.frames():
+      keys.update(frame.keys())
+    return keys
@@ -1,16 +1,30 @@
+import time
+_started_ = time.perf_counter()
+import sys
 import readline
 import Completer
 import atexit
 import util
 
 if __name__ == "__main__":
-  util.initialize_environment("_environ_.json")
-  completer = Completer.Completer(util._environ_)
-  try:
-    readline.read_history_file(util._environ_["history"]["file"])
+  if "--resume" in sys.argv:
+    # a snapshot replaces the configuration and the init file
+    with util.timed("resume snapshot"):
+      util.resume(sys.argv[sys.argv.index("--resume") + 1])
+  else:
+    util.initialize_environment("_environ_.json")
+  with util.timed("completion and history"):
+    completer = Completer.Completer(util._environ_)
     readline.set_completer(completer.complete)
+    readline.set_pre_input_hook(completer.warm)
     readline.parse_and_bind("tab: complete")
-  except FileNotFoundError:
-    pass
-  atexit.register(readline.write_history_file, util._environ_["history"]["file"])
+    try:
+      readline.read_history_file(util._environ_["history"]["file"])
+    except FileNotFoundError:
+      # the first run has no history yet
+      pass
+    atexit.register(readline.write_history_file, util._environ_["history"]["file"])
+  util._timings_.append(("first prompt", time.perf_counter() - _started_))
+  if "--profile-startup" in sys.argv:
+    print(util.startup_profile())
   util.repl()
@@ -0,0 +1,29 @@
+import os
+import sys
+import time
+import tempfile
+import pathlib
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from integration import start, util
+from tokenizer import Tokenizer
+
+def pipeline(stages):
+  return " | ".join([f"echo stage{i} 'quoted {i}'" for i in range(stages)])
+
+def bench_tokenizer(stages, repeat=5):
+  s = pipeline(stages)
+  best = None
+  for _ in range(repeat):
+    began = time.perf_counter()
+    # the stages are grouped on first use, so they are built here too
+    Tokenizer(**util._environ_["statement"]).tokenize(s).stages
+    elapsed = time.perf_counter() - began
+    best = elapsed if best is None else min(best, elapsed)
+  return best
+
+if __name__ == "__main__":
+  start(pathlib.Path(tempfile.mkdtemp()), "parts.py", "std.py")
+  print(f"{'stages':>8} {'chars':>8} {'ms':>10} {'us/stage':>10}")
+  for stages in [10, 30, 100, 300, 1000, 3000]:
+    seconds = bench_tokenizer(stages)
+    print(f"{stages:>8} {len(pipeline(stages)):>8} {seconds * 1000:>10.3f} {seconds * 1e6 / stages:>10.2f}")
@@ -1,2 +1,507 @@
+import os
+import sys
+import json
+import subprocess
+import pytest
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+sys.path.append(os.path.join(ROOT, "modules"))
+import util
+import Completer
+
+def start(tmp_path, *modules, lazy=[]):
+  config = json.load(open(os.path.join(ROOT, "_environ_.json")))
+  config["module_dir"] = os.path.join(ROOT, "modules")
+  config["init"] = {"file": os.path.join(ROOT, "init.tau"), "modules": list(modules), "lazy": list(lazy)}
+  path = tmp_path / "_environ_.json"
+  path.write_text(json.dumps(config))
+  util.initialize_environment(str(path))
+  return util
+
+def run(s):
+  return util.tokenize(s)()
+
 def test_always_passes():
-    assert True
\ No newline at end of file
+    assert True
+
+def test_statement_cache_reuses_trees(tmp_path):
+  start(tmp_path, "parts.py", "std.py")
+  assert util.tokenize("echo a | echo b") is util.tokenize("echo a | echo b")
+  assert run("echo a | echo b") == "a b"
+  assert run("echo a | echo b") == "a b"
+
+def test_statement_cache_invalidates_on_new_variable(tmp_path):
+  start(tmp_path, "parts.py", "std.py")
+  before = util.tokenize("echo x")
+  run("x = 5")
+  assert util.tokenize("echo x") is not before
+  assert run("echo x") == "5"
+
+def test_tokenizer_long_pipeline_is_flat(tmp_path):
+  start(tmp_path, "parts.py", "std.py")
+  tree = util.tokenize(" | ".join(["echo a"] * 1000))
+  assert len(tree.statements) == 1000
+  assert run("echo 'a b' | echo c") == "a b c"
+
+def test_evaluate_indexes_new_commands(tmp_path):
+  start(tmp_path, "parts.py", "std.py")
+  assert util.get_command("twice") is None
+  util.evaluate("def twice(x):\n  return x + x")
+  assert run("twice ab") == "abab"
+
+def test_entry_balance_ignores_quoted_brackets(tmp_path):
+  start(tmp_path, "parts.py", "std.py", "lisp.py")
+  util.reset_current("[a ']'")
+  assert util.entry_incomplete()
+  util.extend_current("\n]")
+  assert not util.entry_incomplete()
+  assert util._balance_.lines == 1
+  assert util._current_ == "[a ']'\n]"
+  assert util.tokenize(util._current_)() == ["a", "]"]
+  util.reset_current('{len("}")')
+  assert util.entry_incomplete()
+  util.extend_current("}")
+  assert not util.entry_incomplete()
+  assert util.tokenize(util._current_).head()() == "1"
+  assert run("[x o'neil 'two words']") == ["x", "o'neil", "two words"]
+
+def test_pipe_streams_before_upstream_finishes(tmp_path):
+  start(tmp_path, "parts.py", "std.py")
+  util.evaluate("import itertools\ndef count(*a):\n  return Stream(itertools.count())")
+  out = run("count | where 7 | where 77")
+  assert next(iter(out)) == 77
+  assert str(run("echo a | where a")) == "a"
+  assert run("lines x | echo b") == "x b"
+
+def test_external_pipe_uses_stdin(tmp_path):
+  start(tmp_path, "parts.py", "std.py")
+  tree = util.tokenize("printf 'b\\na\\n' | sort | head -n 1")
+  assert len(tree.stages) == 1
+  assert str(run("printf 'b\\na\\n' | sort | head -n 1")) == "a"
+  assert str(run("printf 'b\\na\\n' | sort | where b")) == "b"
+
+def test_external_output_streams_stderr_and_caps_memory(tmp_path, capsys):
+  start(tmp_path, "parts.py", "std.py")
+  assert str(run("sh -c 'echo err 1>&2; echo out'")) == "out"
+  assert "err" in capsys.readouterr().err
+  assert util.cmd(sys.executable, "-c", "print('x' * 100000)") == "x" * 100000
+  (tmp_path / "a1").write_text("12")
+  (tmp_path / "a2").write_text("345")
+  assert util.cmd("cat", str(tmp_path) + "/a*") == "12345"
+  assert util.cmd("echo", "two  spaces") == "two  spaces"
+  assert str(run("printf '%s' 'a*'")) == "a*"
+  util._environ_["output"]["limit"] = 10
+  with pytest.raises(Exception, match="limit"):
+    str(run("seq 1 100"))
+
+def test_stderr_without_newline_is_forwarded_at_once(tmp_path):
+  start(tmp_path, "parts.py", "std.py")
+  class Target:
+    text = ""
+    def write(self, s):
+      self.text += s
+    def flush(self):
+      pass
+  target = Target()
+  proc = subprocess.Popen(["sh", "-c", "printf 'progress 50%%\\r' 1>&2; sleep 1"], stderr=subprocess.PIPE)
+  reader = util.threading.Thread(target=util.forward_output, args=(proc.stderr, target, 65536), daemon=True)
+  reader.start()
+  deadline = util.time.time() + 0.5
+  while "progress" not in target.text and util.time.time() < deadline:
+    util.time.sleep(0.01)
+  assert target.text == "progress 50%\r"
+  proc.wait()
+  reader.join()
+
+def test_background_jobs_store_results(tmp_path, capsys):
+  start(tmp_path, "parts.py", "std.py")
+  util.reset_current("echo hi &")
+  util.run_current()
+  number = max(util._jobs_.keys())
+  assert util.wait(number) == "hi"
+  assert util._environ_[f"job{number}"] == "hi"
+  assert "done" in util.jobs()
+  assert util.fg(number) == "hi"
+  assert number not in util._jobs_
+
+def test_parallel_map_and_where_preserve_order(tmp_path):
+  start(tmp_path, "parts.py", "std.py", "lisp.py")
+  lisp = util._environ_["lisp"]
+  util._environ_["parallel"]["serial_below"] = 10
+  assert lisp["pmap"](range(1000), str, 7) == [str(i) for i in range(1000)]
+  assert lisp["pwhere"](range(1000), lambda i: i % 3 == 0) == list(range(0, 1000, 3))
+  assert lisp["pmap"]([1, 2], lambda i: i * 2) == [2, 4]
+
+def test_parallel_spawned_workers_after_cd(tmp_path):
+  # a fresh interpreter only has the repo root on its path, as taush.py does
+  start(tmp_path, "parts.py", "std.py", "lisp.py")
+  away = tmp_path / "away"
+  away.mkdir()
+  script = f"""
+import sys, os
+sys.path.insert(0, {ROOT!r})
+os.chdir({ROOT!r})
+import util
+util.initialize_environment({str(tmp_path / "_environ_.json")!r})
+util._environ_["parallel"].update({{"pool": "process", "start_method": "spawn", "serial_below": 10, "workers": 2}})
+os.chdir({str(away)!r})
+lisp = util._environ_["lisp"]
+print(lisp["pmap"](range(100), str) == [str(i) for i in range(100)])
+import types
+phantom = sys.modules["phantom"] = types.ModuleType("phantom")
+exec(compile("def unreachable(x):\\n  return x + 1\\n", "phantom.py", "exec"), phantom.__dict__)
+print(lisp["pmap"](range(100), phantom.unreachable) == list(range(1, 101)) and ("process", "spawn") not in sys.modules["lisp"]._pools_)
+util.evaluate("def sq(x):\\n  return x * x\\n")
+print(lisp["pmap"](range(100), util.sq) == [i * i for i in range(100)])
+lisp["upper"] = str.upper
+lisp["words"] = ["w" + str(i) for i in range(100)]
+lam = util.tokenize("[\\\\ x [upper x]]")()
+print(sys.modules["lisp"].pool_kind(lam) == "process")
+print(util.tokenize("[pmap words [\\\\ x [upper x]]]")() == ["W" + str(i) for i in range(100)])
+"""
+  result = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, timeout=120)
+  assert result.stdout.split()[-5:] == ["True"] * 5, result.stdout + result.stderr
+
+def test_lisp_compiles_once_and_rebinds(tmp_path):
+  start(tmp_path, "parts.py", "std.py", "lisp.py")
+  lisp = util._environ_["lisp"]
+  lisp["nums"] = [1, 2, 3]
+  lisp["double"] = lambda x: x * 2
+  tree = util.tokenize("[map nums [\\ x [double x]]]")
+  assert run("[map nums [\\ x [double x]]]") == [2, 4, 6]
+  lisp["define"]("double", lambda x: x * 10)
+  assert util.tokenize("[map nums [\\ x [double x]]]") is tree
+  assert run("[map nums [\\ x [double x]]]") == [10, 20, 30]
+  assert run("[[pwd] hello]") == [os.getcwd(), "hello"]
+  lisp = util._environ_["lisp"]
+  lisp["nums"] = [7, 8, 9]
+  assert run("[map nums [\\ x x]]") == [7, 8, 9]
+  lisp["greet"] = lambda: "hi"
+  assert run("[greet]") == "hi"
+  del lisp["greet"]
+  assert run("[greet]") == ["greet"]
+
+def test_lisp_redefines_names(tmp_path):
+  start(tmp_path, "parts.py", "std.py", "lisp.py")
+  run("[define f 1]")
+  assert run("[define f 2]") == "2"
+  assert util._environ_["lisp"]["f"] == "2"
+  assert "1" not in util._environ_["lisp"]
+  assert run("[1 2 3]") == ["1", "2", "3"]
+  run("[define g [\\ x x]]")
+  run("[define g [\\ x [h x]]]")
+  assert run("[g 5]") == ["h", "5"]
+  assert run("[map [1 2 3] [\\ x x]]") == ["1", "2", "3"]
+
+def test_logicdb_facts_share_one_connection(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  start(tmp_path, "parts.py", "std.py", "lisp.py", "logicdb.py")
+  ldb = util._environ_["ldb"]
+  run("[predicate parent parent name,child]")
+  run("[! parent tom bob]")
+  run("[! parent bob it's]")
+  assert list(ldb.data_query("select count(*) as n from parent")) == [{"n": 2}]
+  assert len(ldb.connections) == 1
+  assert "parent" in ldb.tables
+
+def test_logicdb_bulk_load_sources(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  start(tmp_path, "parts.py", "std.py", "lisp.py", "logicdb.py")
+  ldb = util._environ_["ldb"]
+  ldb.create_predicate("edge", "edge", "a,b")
+  seen = []
+  assert ldb.bulk_load("edge", ((i, i + 1) for i in range(2500)), 1000, seen.append) == 2500
+  assert seen == [1000, 2000, 2500]
+  (tmp_path / "edges.csv").write_text("x,'y\nz,w\n")
+  assert ldb.load_facts("edge", str(tmp_path / "edges.csv")) == 2
+  (tmp_path / "edges.jsonl").write_text('{"b": 2, "a": 1}\n[3, 4]\n')
+  assert ldb.load_facts("edge", str(tmp_path / "edges.jsonl")) == 2
+  assert run("printf 'p q\\nr s\\n' | facts edge") == "2 facts loaded"
+  assert list(ldb.data_query("select count(*) as n from edge")) == [{"n": 2506}]
+
+def test_logicdb_indexes_bound_fields(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  start(tmp_path, "parts.py", "std.py", "lisp.py", "logicdb.py")
+  ldb = util._environ_["ldb"]
+  ldb.create_predicate("parent", "parent", "name,child")
+  ldb.bulk_load("parent", [("tom", "bob"), ("bob", "ann"), ("tom", "liz")])
+  assert sorted([r["X"] for r in run("[! parent tom X]")]) == ["bob", "liz"]
+  assert ldb.index_report() == ""
+  list(run("[! parent tom X]"))
+  list(run("[! parent tom X]"))
+  assert run("[indexes]") == "tau_ix_parent_name on parent(name, child) hits 3"
+  plan = list(ldb.data_query("explain query plan select child from parent where name = 'tom'"))
+  assert "COVERING INDEX" in plan[0]["detail"]
+  assert run("[? parent tom liz]") is True
+  assert run("[? parent tom ann]") is False
+
+def test_logicdb_recursive_rules_compile_to_views(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  start(tmp_path, "parts.py", "std.py", "lisp.py", "logicdb.py")
+  ldb = util._environ_["ldb"]
+  ldb.create_predicate("parent", "parent", "name,child")
+  ldb.bulk_load("parent", [("tom", "bob"), ("bob", "ann"), ("ann", "joe"), ("joe", "tom")])
+  run("[! ancestor X Y [[parent X Y]]]")
+  assert run("[! ancestor X Y [[parent X Z] [ancestor Z Y]]]") == "ancestor/2 has 2 rules"
+  assert sorted([r["Y"] for r in run("[! ancestor tom Y]")]) == ["ann", "bob", "joe", "tom"]
+  assert run("[? ancestor bob tom]") is True
+  run("[! descendant X Y [[parent X Y]]]")
+  run("[! descendant X Y [[descendant X Z] [parent Z Y]]]")
+  assert sorted([r["Y"] for r in run("[! descendant tom Y]")]) == ["ann", "bob", "joe", "tom"]
+  run("[! grandparent X Y [[parent X Z] [parent Z Y]]]")
+  assert [r["Y"] for r in run("[! grandparent tom Y]")] == ["ann"]
+  ldb.bulk_load("parent", [("tom", "ann")])
+  answers = run("[! descendant X ann]")
+  assert sorted([r["X"] for r in answers]) == ["ann", "bob", "joe", "tom"]
+  assert len(answers) == 4
+  with pytest.raises(Exception, match="not used"):
+    run("[! broken X Y [[parent X Z]]]")
+  assert ldb.find_predicate("broken", 2).rules == []
+  run("[! p X Y [[parent X Y]]]")
+  run("[! q X Y [[p X Y]]]")
+  with pytest.raises(Exception, match="recursive through q/2"):
+    run("[! p X Y [[q X Z] [parent Z Y]]]")
+  assert len(ldb.find_predicate("p", 2).rules) == 1
+  assert sorted([r["Y"] for r in run("[! p tom Y]")]) == ["ann", "bob"]
+
+def test_logicdb_reuses_query_plans_and_explains(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  start(tmp_path, "parts.py", "std.py", "lisp.py", "logicdb.py")
+  ldb = util._environ_["ldb"]
+  ldb.create_predicate("parent", "parent", "name,child")
+  ldb.bulk_load("parent", [("tom", "bob"), ("bob", "ann"), ("o'neil", "sam")])
+  assert [r["Y"] for r in run("[! parent tom Y]")] == ["bob"]
+  assert [r["Y"] for r in run("[! parent o'neil Y]")] == ["sam"]
+  assert len(ldb.plans) == 1
+  plan = run("[explain parent tom Y]")
+  assert ":a0" in plan.splitlines()[0]
+  assert "parent" in plan.splitlines()[1]
+
+def test_logicdb_links_parts_by_name(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  start(tmp_path, "parts.py", "std.py", "lisp.py", "logicdb.py")
+  ldb = util._environ_["ldb"]
+  ldb.create_predicate("person", "person", "name,age")
+  ldb.create_predicate("pet", "pet", "name,owner")
+  assert run("[link owner [pet.owner person.name]]") == "owner links 1 parts"
+  assert run("[link owner [pet.owner person.name]]") == "owner links 0 parts"
+  ldb.close()
+  reloaded = type(ldb)("logic.db")
+  owner = reloaded.find_predicate("pet", 2).parts_by_seq[1]
+  assert [link.remote_part.predicate.name for link in owner.links_out] == ["person"]
+  assert reloaded.find_predicate("person", 2).parts_by_seq[0].links_in[0].local_part is owner
+  assert reloaded.find_part("pet.owner") is owner
+  assert [p.name for p in reloaded.predicates_by_name["pet"]] == ["pet"]
+  with pytest.raises(Exception, match="not found"):
+    reloaded.find_part("pet.missing")
+
+def test_logicdb_results_stream_in_pages(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  start(tmp_path, "parts.py", "std.py", "lisp.py", "logicdb.py")
+  ldb = util._environ_["ldb"]
+  ldb.page_size = 3
+  ldb.create_predicate("number", "number", "value")
+  ldb.bulk_load("number", [(str(i),) for i in range(10)])
+  result = run("[! number X]")
+  assert isinstance(result, util.Stream)
+  assert len(result) == 10
+  assert [r["X"] for r in result.page(3, 4)] == ["4", "5", "6"]
+  assert [r["X"] for r in result.skip(8)] == ["8", "9"]
+  assert result.take(5).skip(3).first() == {"X": "3"}
+  assert run("[first [! number X]]") == {"X": "0"}
+  assert run("[? number 7]") is True
+  assert run("[? number 70]") is False
+  assert str(run("[! number X] | where 9")) == "{'X': '9'}"
+  numbers = run("[! number X]")
+  assert len(str(numbers).splitlines()) == 10
+  ldb.bulk_load("number", [("10",)])
+  assert len(str(numbers).splitlines()) == 11
+
+def test_logicdb_memory_attach_and_backup(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  start(tmp_path, "parts.py", "std.py", "lisp.py", "logicdb.py")
+  ldb = type(util._environ_["ldb"])(":memory:")
+  util._environ_["ldb"] = ldb
+  ldb.create_predicate("person", "person", "name,city")
+  ldb.bulk_load("person", [("tom", "oslo"), ("ann", "rome")])
+  run("[attach shard shard.db]")
+  ldb.create_predicate("visit", "shard.visit", "name,city")
+  ldb.bulk_load("visit", [("tom", "rome"), ("ann", "oslo")])
+  for _ in range(3):
+    assert [r["C"] for r in run("[! visit tom C]")] == ["rome"]
+  assert "shard.tau_ix_visit_name" in ldb.index_report()
+  run("[! traveller N [[person N H] [visit N C]]]")
+  assert sorted([r["N"] for r in run("[! traveller N]")]) == ["ann", "tom"]
+  assert ldb.connection().execute("pragma database_list").fetchone()[2] == ""
+  run("[backup saved.db]")
+  run("[detach shard]")
+  saved = type(ldb)("saved.db")
+  assert [r["N"] for r in saved.run("person", "N", "oslo")] == ["tom"]
+  assert len(saved.find_predicate("traveller", 1).rules) == 1
+
+def test_logicdb_write_behind_reads_its_own_writes(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  start(tmp_path, "parts.py", "std.py", "lisp.py", "logicdb.py")
+  ldb = type(util._environ_["ldb"])("facts.db", write_behind=True)
+  util._environ_["ldb"] = ldb
+  ldb.create_predicate("number", "number", "value UNIQUE")
+  for i in range(200):
+    run(f"[! number {i}]")
+  assert len(run("[! number X]")) == 200
+  run("[! number 5]")
+  with pytest.raises(Exception, match="not written"):
+    run("[flush]")
+  run("[! number 500]")
+  assert run("[flush]") == "flushed"
+  assert len(run("[! number X]")) == 201
+
+def test_logicdb_materialized_rules_follow_fact_changes(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  start(tmp_path, "parts.py", "std.py", "lisp.py", "logicdb.py")
+  ldb = util._environ_["ldb"]
+  ldb.create_predicate("edge", "edge", "src,dst")
+  ldb.bulk_load("edge", [("a", "b"), ("b", "c")])
+  run("[! reach X Y [[edge X Y]]]")
+  run("[! reach X Y [[edge X Z] [reach Z Y]]]")
+  run("[! hop2 X Y [[edge X Z] [edge Z Y]]]")
+  run("[materialize reach 2]")
+  run("[materialize hop2 2]")
+  changes = []
+  ldb.find_predicate("hop2", 2).change_hooks.append(lambda predicate, rows, sign: changes.append((sign, rows)))
+  run("[! edge c d]")
+  assert sorted([r["Y"] for r in run("[! reach a Y]")]) == ["b", "c", "d"]
+  assert changes == [(1, [{"arg0": "b", "arg1": "d"}])]
+  run("[! edge a x]")
+  run("[! edge x c]")
+  assert run("[retract edge b c]") == "1 facts retracted"
+  assert sorted([r["Y"] for r in run("[! reach a Y]")]) == ["b", "c", "d", "x"]
+  assert sorted([r["Y"] for r in run("[! hop2 a Y]")]) == ["c"]
+  assert [r["Y"] for r in run("[! hop2 b Y]")] == []
+
+def test_logicdb_custom_predicates(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  start(tmp_path, "parts.py", "std.py", "lisp.py", "logicdb.py")
+  ldb = util._environ_["ldb"]
+  seen = []
+  def query_hook(predicate, arguments):
+    return [{"X": str(int(arguments[0].value) * 2)}]
+  ldb.register(sys.modules["logicdb"].CustomPredicate("double", ["value", "result"], query_hook, [lambda predicate, arguments: seen.append(arguments[0].value) is None]))
+  assert run("[! double 21 X]") == [{"X": "42"}]
+  assert run("[! double 1 2]") is True
+  assert seen == ["1"]
+
+def test_completer_indexes_names_and_caches_directories(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  start(tmp_path, "parts.py", "std.py")
+  (tmp_path / "notes.txt").write_text("")
+  util._environ_["completion"] = {"budget_ms": 1000}
+  completer = Completer.Completer(util._environ_)
+  completer.warm()
+  assert completer.directory_index().done.wait(1)
+  assert completer.complete("note", 0) == "'notes.txt'"
+  assert "echo" in [completer.complete("ec", i) for i in range(5)]
+  assert completer.complete("os.path.jo", 0) == "os.path.join"
+  index = completer.directory_index()
+  assert completer.directory_index() is index
+  (tmp_path / "notebook").write_text("")
+  os.utime(tmp_path, ns=(0, 0))
+  assert [completer.complete("note", i) for i in range(2)] == ["'notebook'", "'notes.txt'"]
+
+def test_completer_returns_partial_listings_within_budget(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  start(tmp_path, "parts.py", "std.py")
+  util._environ_["completion"] = {"budget_ms": 1}
+  completer = Completer.Completer(util._environ_)
+  listing = Completer.DirectoryListing(os.path.abspath("."), os.stat(".").st_mtime_ns)
+  listing.names = ["notes.txt"]
+  completer.directories[listing.path] = listing
+  assert completer.complete("note", 0) == "'notes.txt'"
+  assert not listing.done.is_set()
+
+def test_lazy_modules_load_on_first_use(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  start(tmp_path, "parts.py", "std.py", "lisp.py", "logicdb.py", lazy=["logicdb.py"])
+  assert "ldb" not in util._environ_
+  assert "stub logicdb.py" in util.startup_profile()
+  run("[predicate person person name,city]")
+  assert "ldb" in util._environ_
+  run("[! person tom oslo]")
+  assert [r["C"] for r in run("[! person tom C]")] == ["oslo"]
+  start(tmp_path, "parts.py", "std.py", "lisp.py", "logicdb.py", lazy=["logicdb.py"])
+  assert util.get_command("facts").__module__ == "logicdb"
+  assert "ldb" in util._environ_
+
+def test_lazy_modules_index_names_from_on_load(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  start(tmp_path, "parts.py", "std.py", "lisp.py")
+  util._environ_["module_dir"] = str(tmp_path)
+  (tmp_path / "extra.py").write_text('''
+def on_load(env):
+  global registered
+  registered = lambda *a: "registered"
+  env["lisp"]["assigned"] = lambda: "assigned"
+  for name in ["generated"]:
+    env["lisp"][name] = lambda: name
+''')
+  util.load_lazy("extra.py")
+  assert "generated" not in util.module_manifest(str(tmp_path / "extra.py"))[1]
+  assert util.get_command("registered")() == "registered"
+  assert run("[assigned]") == "assigned"
+  assert "generated" in util.module_manifest(str(tmp_path / "extra.py"))[1]
+  util.load_lazy("extra.py")
+  assert run("[generated]") == "generated"
+
+def test_snapshot_restores_user_state(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  start(tmp_path, "parts.py", "std.py", "lisp.py", "logicdb.py", lazy=["logicdb.py"])
+  util._environ_["greeting"] = "hello"
+  util._environ_["big"] = "x" * 100000
+  util._environ_["blob"] = b"\x00\x01"
+  run("[define answer 42]")
+  util.save("session.snapshot")
+  util.save(lambda: [1, 2, 3], "value.snapshot")
+  util._environ_["greeting"] = "changed"
+  util.resume("session.snapshot")
+  assert util._environ_["greeting"] == "hello"
+  assert util._environ_["big"] == "x" * 100000
+  assert bytes(util._environ_["blob"]) == b"\x00\x01"
+  assert isinstance([m for m in util._environ_["modules"] if not hasattr(m, "__file__")][0], util.ModuleStub)
+  assert util._environ_["lisp"]["answer"] == "42"
+  assert run("[define other 7]") == "7"
+  assert util._environ_["lisp"]["other"] == "7"
+  util.resume("numbers", "value.snapshot")
+  assert util._environ_["numbers"] == [1, 2, 3]
+
+def test_scopes_push_pop_and_lambdas(tmp_path):
+  start(tmp_path, "parts.py", "std.py", "lisp.py")
+  run("x = 5")
+  run("push")
+  run("x = 7")
+  assert run("echo x") == "7"
+  run("pop")
+  assert run("echo x") == "5"
+  assert util.dowith(lambda: util.lookup("y"), y="bound") == "bound"
+  assert util.lookup("y") is None
+  double = util.tokenize(r"\ n {int(n) * 2}").head()
+  assert util._environ_["lisp"]["map"](range(1000), double)[:3] == ["0", "2", "4"]
+  assert len(double.frames) == 1
+  assert util._scope_.depth() == 0
+  assert util.dowith(lambda: run("[map [1 2] [\\ a q]]"), q="scoped") == ["scoped", "scoped"]
+
+def test_resume_releases_earlier_maps_and_database(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  start(tmp_path, "parts.py", "std.py", "lisp.py", "logicdb.py")
+  util._environ_["snapshot"]["blob_above"] = 16
+  util._environ_["blob"] = b"x" * 1000
+  util.save("session.snapshot")
+  ldb = util._environ_["ldb"]
+  util.resume("session.snapshot")
+  assert ldb.connections == []
+  first = util._snapshot_maps_[-1][1]
+  util.resume("session.snapshot")
+  assert first.closed
+  assert len(util._snapshot_maps_) == 1
+  assert bytes(util._environ_["blob"]) == b"x" * 1000
+  util.save("session.snapshot")
+  assert util._snapshot_maps_ == []
+  assert util._environ_["blob"] == b"x" * 1000
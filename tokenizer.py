@@ -1,3 +1,7 @@
+import re
+
+_word_ = re.compile(r"\S+")
+
 class Tokenizer:
   def __init__(self, create_part, create_call, binaries = [],  segments = [],  prefixes = []):
     self.create_part = create_part
@@ -5,65 +9,146 @@ class Tokenizer:
     self.binaries = binaries
     self.segments = segments
     self.prefixes = prefixes
-    self.token = ""
-    self.index = -1
+    # lookup tables keyed by character, first registration wins
+    self.binary_table = {}
+    for binary in binaries:
+      self.binary_table.setdefault(binary[0], (binary[2] if len(binary) > 2 else 0, binary[1]))
+    self.segment_table = {}
+    for open_c, close_c, fact in segments:
+      self.segment_table.setdefault(open_c, (close_c, fact, open_c != close_c))
+    self.balance = None
+    self.prefix_table = {}
+    for char, count, fact in prefixes:
+      self.prefix_table.setdefault(char, (count, fact))
     self.tokens = []
     self.builders = []
+    self.operands = []
+    self.operators = []
 
   def append(self, token):
     self.tokens.append(token)
-    if len(self.builders) > 0:
-      if len(self.tokens) - self.builders[-1][1] == self.builders[-1][0]:
-        self.tokens[self.builders[-1][1]] = self.builders[-1][2](*self.tokens[self.builders[-1][1]:])
-        self.tokens = self.tokens[:self.builders[-1][1] + 1]
-        self.builders.pop()
-    self.token = ""
-  
+    while len(self.builders) > 0 and len(self.tokens) - self.builders[-1][1] == self.builders[-1][0]:
+      count, start, fact = self.builders.pop()
+      arguments = self.tokens[start:]
+      del self.tokens[start:]
+      self.tokens.append(fact(*arguments))
+
   def set_builder(self, c):
-    for char, count, fact in self.prefixes:
-        if c == char:
-          self.builders.append((count, len(self.tokens), fact))
-          return  True
-    return False
-  
-  def build_binary(self, c, s):
-    for char, fact in self.binaries:
-      if c == char:
-        left = self.create_call(*self.tokens) if len(self.tokens) > 1 else self.tokens[-1]
-        right = Tokenizer(self.create_part, self.create_call, self.binaries, self.segments, self.prefixes).tokenize(s[(self.index + 1):])
-        return fact(left, right)
-    return None
-  
-  def build_segment(self, c):
-    for open_c, close_c, fact in self.segments:
-          if self.token.startswith(open_c):
-            if c == close_c:
-              self.append(fact(self.token[1:]))
-              return True
-    return False
-  
+    count, fact = self.prefix_table[c]
+    self.builders.append((count, len(self.tokens), fact))
+
+  def reduce(self):
+    precedence, fact = self.operators.pop()
+    right = self.operands.pop()
+    left = self.operands.pop()
+    self.operands.append(fact(left, right))
+
+  def build_binary(self, c):
+    precedence, fact = self.binary_table[c]
+    self.operands.append(self.create_call(*self.tokens) if len(self.tokens) > 1 else self.tokens[-1])
+    # binaries are right associative, so only reduce tighter operators
+    while len(self.operators) > 0 and self.operators[-1][0] > precedence:
+      self.reduce()
+    self.operators.append((precedence, fact))
+    self.tokens = []
+    self.builders = []
+
+  def segment_end(self, s, index):
+    close_c, fact, nesting = self.segment_table[s[index]]
+    if not nesting:
+      return s.find(close_c, index + 1)
+    # the same scan as multi-line entry, so quoted brackets never close a segment
+    if self.balance is None:
+      self.balance = Balance(self.segments)
+    return self.balance.closing(s, index)
+
   def tokenize(self, s):
-    for c in s:
-      self.index += 1
-      if self.token == "":
-        if not c.isspace():
-          if not self.set_builder(c):
-            b = self.build_binary(c, s)
-            if b is not None:
-              return b          
-            self.token += c
+    index = 0
+    length = len(s)
+    while index < length:
+      c = s[index]
+      if c.isspace():
+        index += 1
+      elif c in self.prefix_table:
+        self.set_builder(c)
+        index += 1
+      elif c in self.binary_table:
+        self.build_binary(c)
+        index += 1
+      else:
+        end = self.segment_end(s, index) if c in self.segment_table else -1
+        if end >= 0:
+          self.append(self.segment_table[c][1](s[index + 1:end]))
+          index = end + 1
+        else:
+          word = _word_.match(s, index)
+          self.append(self.create_part(word.group()))
+          index = word.end()
+    self.operands.append(self.create_call(*self.tokens))
+    while len(self.operators) > 0:
+      self.reduce()
+    return self.operands[-1]
+
+class Balance:
+  def __init__(self, segments = []):
+    self.quotes = set()
+    self.closers = {}
+    self.depth = {}
+    for open_c, close_c, fact in segments:
+      if open_c == close_c:
+        self.quotes.add(open_c)
+      else:
+        self.depth[open_c] = 0
+        self.closers[close_c] = open_c
+    characters = "".join(self.quotes) + "".join(self.depth.keys()) + "".join(self.closers.keys())
+    self.special = re.compile(f"[{re.escape(characters)}]") if characters != "" else None
+    self.quote = None
+    self.lines = 0
+
+  def scan(self, s, index=0):
+    # yields each bracket outside quotes with its position, the quote state carries across calls
+    while self.special is not None and index < len(s):
+      if self.quote is not None:
+        end = s.find(self.quote, index)
+        if end < 0:
+          return
+        self.quote = None
+        index = end + 1
+        continue
+      match = self.special.search(s, index)
+      if match is None:
+        return
+      c = match.group()
+      if c in self.quotes:
+        # a quote inside a word does not open, o'neil is a plain word
+        start = match.start()
+        if start == 0 or not s[start - 1].isalnum():
+          self.quote = c
+      elif c in self.depth:
+        self.depth[c] += 1
+        yield c, match.start()
       else:
-        if not self.build_segment(c):
-          if c.isspace():
-            self.append(self.create_part(self.token))
-            if len(self.builders) > 0:
-              if len(self.tokens) - self.builders[-1][1] == self.builders[-1][0]:
-                self.tokens[self.builders[-1][1]] = self.builders[-1][2](*self.tokens[self.builders[-1][1]:])
-                self.tokens = self.tokens[:self.builders[-1][1] + 1]
-                self.builders.pop()
-            self.token = ""
-          else:
-            self.token += c
-    if self.token != "":
-      self.append(self.create_part(self.token))
-    return self.create_call(*self.tokens)
\ No newline at end of file
+        self.depth[self.closers[c]] -= 1
+        yield c, match.start()
+      index = match.end()
+
+  def feed(self, s):
+    # only the new text is scanned, the state carries across lines
+    self.lines += s.count("\n")
+    for c, position in self.scan(s):
+      pass
+    return self
+
+  def closing(self, s, index):
+    # position of the bracket that closes the one at index, or -1
+    self.quote = None
+    for c in self.depth:
+      self.depth[c] = 0
+    open_c = s[index]
+    for c, position in self.scan(s, index):
+      if self.closers.get(c) == open_c and self.depth[open_c] == 0:
+        return position
+    return -1
+
+  def is_open(self):
+    return self.quote is not None or any(d > 0 for d in self.depth.values())
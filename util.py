@@ -1,29 +1,74 @@
 import os
 import importlib.util
-import subprocess
-import pickle 
+import shlex
+import threading
 import json
+import codecs
 import sys
-from proxydictionary import ProxyDict
-from tokenizer import Tokenizer
+import re
+import time
+import mmap
+import gc
+import struct
+from collections import OrderedDict
+from contextlib import contextmanager
+from itertools import count
+from proxydictionary import Scope
+from tokenizer import Tokenizer, Balance
 
 _environ_ = {}
-_environ_stack_ = []
+_scope_ = Scope(_environ_)
 _current_ = ""
 _newline_ = "\n"
+_balance_ = Balance()
+_entry_ = []
+_statement_cache_ = OrderedDict()
+_code_cache_ = OrderedDict()
+_cache_lock_ = threading.RLock()
+_objects_ = {}
+_commands_ = {}
+_jobs_ = {}
+_job_numbers_ = count(1)
+_executor_ = None
+_timings_ = []
+_manifests_ = {}
+_definition_ = re.compile(r"^(?:def|class)\s+(\w+)", re.M)
+_on_load_ = re.compile(r"^def on_load\(.*?\n((?:[ \t]+.*(?:\n|$)|\n)*)", re.M)
+_snapshot_magic_ = b"TAUSNAP\n"
+_snapshot_version_ = 1
+_snapshot_maps_ = []
+_symbol_ = re.compile(r"^\s+\"([^\"]+)\"\s*:", re.M)
+_global_ = re.compile(r"^\s+global\s+([\w, ]+)", re.M)
+_assigned_symbol_ = re.compile(r"\[\"lisp\"\]\[\"([^\"]+)\"\]\s*=")
 
-def get_command(name):
+def index_module(m, override=False):
+  # earlier modules win unless the module is being re-indexed in place
+  items = m._stub_names_.items() if isinstance(m, ModuleStub) else list(vars(m).items())
+  for name, value in items:
+    if override or name not in _objects_:
+      _objects_[name] = m
+    if callable(value) and (override or name not in _commands_):
+      _commands_[name] = m
+
+def index_modules(*a):
+  _objects_.clear()
+  _commands_.clear()
   for m in _environ_["modules"]:
-    if hasattr(m, name):
-      command = getattr(m, name)
-      if callable(command):
-        return command
+    index_module(m)
+
+def get_command(name):
+  m = _commands_.get(name, None)
+  if m is not None:
+    command = getattr(m, name, None)
+    if callable(command):
+      return command
   return None
 
 def get_object(name):
-  for m in _environ_["modules"]:
-    if hasattr(m, name):
-      return getattr(m, name)
+  m = _objects_.get(name, None)
+  if m is not None:
+    return getattr(m, name, None)
+  return None
 
 def coalesce(*args):
   for arg in args:
@@ -34,14 +79,111 @@ def coalesce(*args):
 def clean_string_end(s):
   if s is None or len(s) < 1:
     return None
-  while s[-1] in "\r\n\t ":
-    s = s[:-1]
-  return s
+  return s.rstrip("\r\n\t ")
+
+def output_setting(name, default=None):
+  return _environ_.get("output", {}).get(name, default)
+
+class Stream:
+  # a lazily produced sequence of lines passed between pipe stages
+  def __init__(self, items, limit=None):
+    self.items = items
+    self.limit = limit
+    self.text = None
+
+  def __iter__(self):
+    return iter(self.items)
+
+  def __str__(self):
+    if self.text is None:
+      size = 0
+      items = []
+      for i in self:
+        item = str(i)
+        size += len(item) + 1
+        if self.limit is not None and size > self.limit:
+          raise Exception(f"output is larger than the {self.limit} character limit")
+        items.append(item)
+      self.text = _newline_.join(items)
+    return self.text
+
+def streams(f):
+  # marks a command that accepts a Stream in place of a materialized value
+  f.streams = True
+  return f
+
+class Quoted(str):
+  # text the user quoted, it reaches external commands as one literal word
+  pass
+
+def command_line(items):
+  # bare words go to the shell as typed so globs, variables and redirects expand on every platform
+  items = [item if isinstance(item, str) else str(item) for item in items]
+  if os.name == "nt":
+    import subprocess
+    return subprocess.list2cmdline(items)
+  return " ".join([shlex.quote(item) if isinstance(item, Quoted) or item == "" or re.search(r"\s", item) else item for item in items])
 
 def cmd(*a):
-  proc = subprocess.Popen([str(item) for item in a], stdout=subprocess.PIPE, shell=True)
-  (out, err) = proc.communicate()
-  return clean_string_end(out.decode("utf-8"))
+  return clean_string_end(str(cmd_stream([a])))
+
+def cmd_lines(*a):
+  return cmd_pipeline([a])
+
+def cmd_stream(commands):
+  return Stream(cmd_pipeline(commands), output_setting("limit"))
+
+def forward_output(source, target, chunk):
+  # whatever has arrived is passed on, so progress bars and prompts without a newline show at once
+  decoder = codecs.getincrementaldecoder("utf-8")("replace")
+  for data in iter(lambda: source.read1(chunk), b""):
+    target.write(decoder.decode(data))
+    target.flush()
+  target.write(decoder.decode(b"", final=True))
+  target.flush()
+  source.close()
+
+def cmd_pipeline(commands):
+  # each process reads the previous one's stdout directly, only the last is read here
+  # subprocess is imported on first use, it is a large share of startup
+  import subprocess
+  chunk = output_setting("chunk", 65536)
+  procs = []
+  readers = []
+  stdin = None
+  try:
+    for command in commands:
+      proc = subprocess.Popen(command_line(command), stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
+      if stdin is not None:
+        stdin.close()
+      stdin = proc.stdout
+      procs.append(proc)
+      # stderr is drained alongside stdout so a chatty process never blocks on it
+      reader = threading.Thread(target=forward_output, args=(proc.stderr, sys.stderr, chunk), daemon=True)
+      reader.start()
+      readers.append(reader)
+    # reads are bounded by chunk, a longer line is kept in pieces until its newline arrives
+    limit = output_setting("limit")
+    pieces = []
+    size = 0
+    for data in iter(lambda: procs[-1].stdout.readline(chunk), b""):
+      pieces.append(data)
+      size += len(data)
+      if not data.endswith(b"\n"):
+        if limit is not None and size > limit:
+          raise Exception(f"output is larger than the {limit} character limit")
+        continue
+      yield b"".join(pieces).decode("utf-8", "replace").rstrip("\r\n")
+      pieces = []
+      size = 0
+    if len(pieces) > 0:
+      yield b"".join(pieces).decode("utf-8", "replace").rstrip("\r\n")
+  finally:
+    for proc in procs:
+      proc.stdout.close()
+      proc.wait()
+    for reader in readers:
+      reader.join()
 
 def count_chars(c, s):
   count = 0
@@ -50,60 +192,253 @@ def count_chars(c, s):
       count += 1
   return count
 
-def still_open(o, c):
-  if o == c:
-    return count_chars(o, _current_) % 2 != 0
-  else:
-    return count_chars(o, _current_) > count_chars(c, _current_)
+def reset_current(s=""):
+  global _current_, _balance_
+  _current_ = ""
+  _entry_.clear()
+  _balance_ = Balance(_environ_["statement"]["segments"])
+  extend_current(s)
+
+def extend_current(s):
+  # lines are joined into _current_ once, when the entry is complete
+  global _current_
+  _entry_.append(s)
+  if not _balance_.feed(s).is_open():
+    _current_ = "".join(_entry_)
 
 def entry_incomplete():
-  return any([still_open(o, c) for o, c, _ in _environ_["statement"]["segments"]])
+  return _balance_.is_open()
 
 def is_quitting():
   return _current_.lower() == "quit"
 
 def continue_prompt():
-  global _current_
-  _current_ += input(f'{str(count_chars(_newline_, _current_))}') + _newline_
+  extend_current(input(f'{str(_balance_.lines)}') + _newline_)
 
 def initial_prompt():
-  global _current_
-  _current_ = input(tokenize(_environ_["prompt"])())  
+  report_jobs()
+  reset_current(input(tokenize(_environ_["prompt"])()))
 
 def repl():
-  global _current_
   initial_prompt()
   while not is_quitting():
     if not entry_incomplete():
       run_current()
       initial_prompt()
     else: 
-      _current_ += _newline_
+      extend_current(_newline_)
       continue_prompt()
 
 def run_file(f):
-  global _current_
+  reset_current()
   lines = open(f).readlines()
   for line in lines:
-    _current_ += line
+    extend_current(line)
     if entry_incomplete():
-      _current_ += _newline_
+      extend_current(_newline_)
     else:
       run_current()
 
+def statement_key(s):
+  statement = _environ_["statement"]
+  return (s,
+          tuple(map(tuple, statement["segments"])),
+          tuple(map(tuple, statement["binaries"])),
+          tuple(map(tuple, statement["prefixes"])))
+
+def invalidate_statements(*a):
+  # background jobs invalidate too, so the caches are only touched under the lock
+  with _cache_lock_:
+    _statement_cache_.clear()
+
 def tokenize(s):
-  return Tokenizer(**_environ_["statement"]).tokenize(s)
+  # parsed trees are reused, so statements must not mutate themselves when run
+  key = statement_key(s)
+  with _cache_lock_:
+    tree = _statement_cache_.get(key, None)
+    if tree is not None:
+      _statement_cache_.move_to_end(key)
+      return tree
+  tree = Tokenizer(**_environ_["statement"]).tokenize(s)
+  with _cache_lock_:
+    _statement_cache_[key] = tree
+    while len(_statement_cache_) > _environ_.get("statement_cache", 256):
+      _statement_cache_.popitem(last=False)
+  return tree
 
 def run_current():
-  global _current_
   try:
-    out = tokenize(_current_)()
-    _current_ = ""
-    if out is not None:
+    text = _current_.rstrip()
+    if text.endswith("&"):
+      out = background(text[:-1])
+    else:
+      out = tokenize(_current_)()
+    reset_current()
+    if isinstance(out, Stream):
+      for line in out:
+        print(line, flush=True)
+    elif out is not None:
       print(out)
   except Exception as e:
     print(f"Error: {str(e)}")
-    _current_ = ""
+    reset_current()
+
+class Job:
+  def __init__(self, number, text, future):
+    self.number = number
+    self.text = text
+    self.future = future
+    self.reported = False
+
+  def status(self):
+    if not self.future.done():
+      return "running"
+    return "failed" if self.future.exception() is not None else "done"
+
+  def __str__(self):
+    return f"[{self.number}] {self.status()}  {self.text}"
+
+def run_job(number, tree):
+  out = tree()
+  if isinstance(out, Stream):
+    out = str(out)
+  _environ_[f"job{number}"] = out
+  invalidate_statements()
+  return out
+
+def background(text):
+  # the statement is parsed here so jobs never touch the tokenizer concurrently
+  global _executor_
+  if _executor_ is None:
+    from concurrent.futures import ThreadPoolExecutor
+    _executor_ = ThreadPoolExecutor(max_workers=_environ_.get("background", {}).get("workers", 4))
+  tree = tokenize(text)
+  number = next(_job_numbers_)
+  _jobs_[number] = Job(number, text.strip(), _executor_.submit(run_job, number, tree))
+  return f"[{number}] {text.strip()}"
+
+def report_jobs():
+  for job in _jobs_.values():
+    if job.future.done() and not job.reported:
+      job.reported = True
+      print(job)
+
+def jobs(*a):
+  return _newline_.join([str(job) for job in _jobs_.values()])
+
+def wait(*a):
+  numbers = [int(str(n)) for n in a] if len(a) > 0 else list(_jobs_.keys())
+  for number in numbers:
+    _jobs_[number].future.exception()
+    _jobs_[number].reported = True
+  if len(a) == 1:
+    return _jobs_[numbers[0]].future.result()
+  return jobs()
+
+def fg(*a):
+  if len(_jobs_) == 0:
+    raise Exception("no jobs")
+  number = int(str(a[0])) if len(a) > 0 else max(_jobs_.keys())
+  job = _jobs_.pop(number)
+  return job.future.result()
+
+@contextmanager
+def timed(phase):
+  start = time.perf_counter()
+  try:
+    yield
+  finally:
+    _timings_.append((phase, time.perf_counter() - start))
+
+def startup_profile(*a):
+  return _newline_.join([f"{phase:<40}{seconds * 1000:9.2f} ms" for phase, seconds in _timings_])
+
+def module_manifest(path):
+  # the functions and classes a module defines and the lisp symbols its on_load adds,
+  # read from the source text so the module does not have to run
+  key = (path, os.stat(path).st_mtime_ns)
+  if key not in _manifests_:
+    text = open(path).read()
+    names = _definition_.findall(text)
+    on_load = _on_load_.search(text)
+    symbols = []
+    if on_load is not None:
+      # globals on_load creates and symbols it assigns one at a time are found as well
+      names += [n.strip() for found in _global_.findall(on_load.group(1)) for n in found.split(",") if n.strip() not in names]
+      symbols = _symbol_.findall(on_load.group(1)) + _assigned_symbol_.findall(on_load.group(1))
+    # modules that extend the statement syntax are needed before anything is parsed
+    eager = on_load is not None and '"statement"' in on_load.group(1)
+    _manifests_[key] = (names, symbols, eager)
+  return _manifests_[key]
+
+class ModuleStub:
+  # stands in for a lazy module, the first use of one of its names loads it
+  def __init__(self, item, names, symbols):
+    self._stub_item_ = item
+    self._stub_names_ = dict([(name, ModuleStub) for name in names])
+    self._stub_module_ = None
+    _environ_["lisp"] = _environ_.get("lisp", {}) | dict([(symbol, self._stub_symbol_(symbol)) for symbol in symbols])
+
+  def __getattr__(self, name):
+    if name.startswith("_stub_") or name not in self._stub_names_:
+      raise AttributeError(name)
+    return getattr(self._stub_load_(), name)
+
+  def __dir__(self):
+    return list(self._stub_names_.keys())
+
+  def _stub_symbol_(self, symbol):
+    def call(*args):
+      self._stub_load_()
+      if _environ_["lisp"].get(symbol) is call:
+        raise Exception(f"{self._stub_item_} did not define {symbol}")
+      return _environ_["lisp"][symbol](*args)
+    return call
+
+  def _stub_load_(self):
+    if self._stub_module_ is None:
+      with timed(f"lazy load {self._stub_item_}"):
+        self._stub_module_ = load_module(self._stub_item_, self)
+    return self._stub_module_
+
+def load_module(item, stub=None, reuse=False):
+  name = item.split(".")[0]
+  path = f'{_environ_["module_dir"]}/{item}'
+  mod = sys.modules.get(name, None)
+  if not reuse or mod is None or os.path.abspath(getattr(mod, "__file__", "") or "") != os.path.abspath(path):
+    spec = importlib.util.spec_from_file_location(name, path)
+    mod = importlib.util.module_from_spec(spec)
+    # registered so modules importing each other share one instance
+    sys.modules[name] = mod
+    spec.loader.exec_module(mod)
+  if stub is not None and stub in _environ_["modules"]:
+    # the module takes the stub's place so name lookups keep their order
+    _environ_["modules"][_environ_["modules"].index(stub)] = mod
+    index_modules()
+  else:
+    _environ_["modules"].append(mod)
+    index_module(mod)
+  names = set(vars(mod).keys())
+  symbols = dict(_environ_.get("lisp", {}))
+  mod.on_load(_environ_)
+  # what on_load added is indexed now and remembered for later stubs of the module
+  index_module(mod)
+  learn_manifest(path, [n for n in vars(mod).keys() if n not in names], [k for k, v in _environ_.get("lisp", {}).items() if symbols.get(k) is not v])
+  invalidate_statements()
+  return mod
+
+def learn_manifest(path, names, symbols):
+  key = (path, os.stat(path).st_mtime_ns)
+  known_names, known_symbols, eager = module_manifest(path)
+  _manifests_[key] = (known_names + [n for n in names if n not in known_names], known_symbols + [s for s in symbols if s not in known_symbols], eager)
+
+def load_lazy(item):
+  names, symbols, eager = module_manifest(f'{_environ_["module_dir"]}/{item}')
+  stub = ModuleStub(item, names, symbols)
+  _environ_["modules"].append(stub)
+  index_module(stub)
+  invalidate_statements()
+  return stub
 
 def load(*a):
   # load a module into modules
@@ -111,30 +446,34 @@ def load(*a):
   for item in a:
     if item in local_modules:
       if item.endswith(".py"):
-        name = item.split(".")[0]
-        path = f'{_environ_["module_dir"]}/{item}'
-        spec = importlib.util.spec_from_file_location(name, path)
-        mod = importlib.util.module_from_spec(spec)
-        spec.loader.exec_module(mod)
-        _environ_["modules"].append(mod)
-        if len(a) > 1:
-          _environ_[a[1].text] = mod
-        mod.on_load(_environ_)
-      elif a.endswith(".tau"):
+        load_module(item)
+      elif item.endswith(".tau"):
         run_file(f'{_environ_["module_dir"]}/{item}')
     else:
       _environ_[item] = __import__(item)
       _environ_["modules"].append(_environ_[item] )
       _environ_["modules"][0].__dict__[item] = _environ_[item]
+      index_module(_environ_["modules"][0], True)
+      index_module(_environ_[item])
+      invalidate_statements()
 
 def evaluate(s):
   try:
     if "\n" in s:
       exec(s, _environ_["modules"][0].__dict__)
+      index_module(_environ_["modules"][0], True)
+      invalidate_statements()
       return None
     else:
-      c = compile(s, '', 'eval')
-      r = eval(c, _environ_["modules"][0].__dict__, _environ_)
+      with _cache_lock_:
+        c = _code_cache_.get(s, None)
+      if c is None:
+        c = compile(s, '', 'eval')
+        with _cache_lock_:
+          _code_cache_[s] = c
+          while len(_code_cache_) > _environ_.get("statement_cache", 256):
+            _code_cache_.popitem(last=False)
+      r = eval(c, _environ_["modules"][0].__dict__, _scope_ if _scope_.depth() > 0 else _environ_)
       return str(r)
   except Exception as e:
     print(f"Error: {str(e)}")
@@ -175,46 +514,212 @@ def lisp(s, d):
 def runpy(item):
   return exec(open(item).read())
 
+def snapshot_reference(value):
+  # factories in the statement configuration are stored by module and name
+  if callable(value) and hasattr(value, "__module__") and hasattr(value, "__qualname__"):
+    return {"ref": f"{value.__module__}:{value.__qualname__}"}
+  return value
+
+def snapshot_resolve(value):
+  if isinstance(value, dict) and "ref" in value:
+    module, name = value["ref"].split(":")
+    value = sys.modules[module]
+    for part in name.split("."):
+      value = getattr(value, part)
+  return value
+
+def snapshot_modules():
+  modules = []
+  module_dir = os.path.abspath(_environ_["module_dir"])
+  for m in _environ_["modules"][1:]:
+    if isinstance(m, ModuleStub):
+      modules.append({"item": m._stub_item_})
+    elif os.path.dirname(os.path.abspath(getattr(m, "__file__", "") or "")) == module_dir:
+      modules.append({"item": os.path.basename(m.__file__)})
+    else:
+      modules.append({"import": m.__name__})
+  return modules
+
+def write_snapshot(file_name, variables, lisp={}, statement={}, modules=[]):
+  # magic, header length, json header, then the large values as raw bytes
+  blob_above = _environ_.get("snapshot", {}).get("blob_above", 65536)
+  # a mapped file cannot be replaced everywhere, values still viewing it are copied first
+  path = os.path.abspath(file_name)
+  mapped = [m for p, m in _snapshot_maps_ if p == path]
+  for values in (_environ_, variables):
+    for name, value in list(values.items()):
+      if isinstance(value, memoryview) and any(value.obj is m for m in mapped):
+        values[name] = bytes(value)
+  header = {"version": _snapshot_version_, "variables": {}, "lisp": {}, "blobs": {},
+            "statement": dict([(k, [[snapshot_reference(v) for v in entry] for entry in value] if isinstance(value, list) else snapshot_reference(value)) for k, value in statement.items()]),
+            "modules": modules}
+  chunks = []
+  offset = 0
+  for name, value in variables.items():
+    if isinstance(value, (bytes, bytearray, memoryview)):
+      kind, data = "bytes", bytes(value)
+    else:
+      try:
+        text = json.dumps(value)
+      except (TypeError, ValueError):
+        continue
+      if len(text) <= blob_above:
+        header["variables"][name] = value
+        continue
+      kind, data = ("str", value.encode("utf-8")) if isinstance(value, str) else ("json", text.encode("utf-8"))
+    header["blobs"][name] = [offset, len(data), kind]
+    chunks.append(data)
+    offset += len(data)
+  for name, value in lisp.items():
+    try:
+      json.dumps(value)
+      header["lisp"][name] = value
+    except (TypeError, ValueError):
+      pass
+  data = json.dumps(header, separators=(",", ":")).encode("utf-8")
+  with open(f"{file_name}.tmp", "wb") as f:
+    f.write(_snapshot_magic_)
+    f.write(struct.pack("<Q", len(data)))
+    f.write(data)
+    for chunk in chunks:
+      f.write(chunk)
+  release_snapshot_maps([(p, m) for p, m in _snapshot_maps_ if p == path])
+  os.replace(f"{file_name}.tmp", file_name)
+
+def read_snapshot(file_name):
+  with open(file_name, "rb") as f:
+    if f.read(len(_snapshot_magic_)) != _snapshot_magic_:
+      raise Exception(f"{file_name} is not a session snapshot")
+    length = struct.unpack("<Q", f.read(8))[0]
+    header = json.loads(f.read(length))
+    if header["version"] > _snapshot_version_:
+      raise Exception(f"{file_name} is a version {header['version']} snapshot")
+    start = len(_snapshot_magic_) + 8 + length
+    mapped = None
+    if any(kind == "bytes" for offset, size, kind in header["blobs"].values()) and _environ_.get("snapshot", {}).get("mmap", True):
+      # bytes values are views of the mapping, they are not copied at all
+      mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+      _snapshot_maps_.append((os.path.abspath(file_name), mapped))
+    view = memoryview(mapped) if mapped is not None else None
+    for name, (offset, size, kind) in header["blobs"].items():
+      if view is not None and kind == "bytes":
+        data = view[start + offset:start + offset + size]
+      else:
+        f.seek(start + offset)
+        data = f.read(size)
+      header["variables"][name] = data if kind == "bytes" else str(data, "utf-8") if kind == "str" else json.loads(data)
+    if view is not None:
+      view.release()
+  return header
+
+def release_snapshot_maps(entries):
+  # a mapping stays open while a value still views it
+  for entry in entries:
+    try:
+      entry[1].close()
+      _snapshot_maps_.remove(entry)
+    except BufferError:
+      pass
+
 def save(*a):
-  # save the current environment to a file
-  if len(a) == 0:
-    pickle.dump(_environ_, open("taush.pkl", "wb"))
-  elif len(a) == 1:
-    pickle.dump(_environ_, open(a[0], "wb"))
-  elif len(a) == 2:
-    pickle.dump(a[0](), open(*a[1:], "wb"))
-  else:
+  # save the user's state, not the modules, to a snapshot file
+  if len(a) == 2:
+    write_snapshot(str(a[1]), {"value": a[0]()})
+    return None
+  if len(a) > 2:
     print("Error: save takes 0, 1, or 2 arguments")
+    return None
+  reserved = ["modules", "env", "lisp", "statement"]
+  variables = dict([(k, v) for k, v in _environ_.items() if k not in reserved])
+  write_snapshot(str(a[0]) if len(a) == 1 else "taush.snapshot", variables, _environ_.get("lisp", {}), _environ_["statement"], snapshot_modules())
 
 def resume(*a):
-  # resume the environment from a file
-  if len(a) == 0:
-    _environ_ = pickle.load(open("taush.pkl", "rb"))
-  elif len(a) == 1:
-    _environ_ = pickle.load(open(a[0], "rb"))
-  elif len(a) == 2:
-    _environ_[str(a[0])] = pickle.load(open(*a[1:], "rb"))
-  else:
+  # resume the environment from a snapshot, modules come back lazily where they can
+  global _environ_
+  if len(a) == 2:
+    _environ_[str(a[0])] = read_snapshot(str(a[1]))["variables"].get("value")
+    return None
+  if len(a) > 2:
     print("Error: resume takes 0, 1, or 2 arguments")
+    return None
+  earlier = list(_snapshot_maps_)
+  snapshot = read_snapshot(str(a[0]) if len(a) == 1 else "taush.snapshot")
+  if hasattr(_environ_.get("ldb", None), "close"):
+    _environ_["ldb"].close()
+  _environ_ = snapshot["variables"]
+  _environ_["modules"] = [sys.modules[__name__]]
+  _environ_["env"] = _environ_
+  _environ_["lisp"] = snapshot["lisp"]
+  _environ_["statement"] = {"segments": [], "binaries": [], "prefixes": []}
+  _scope_.base = _environ_
+  _scope_.frames().clear()
+  index_modules()
+  invalidate_statements()
+  for entry in snapshot["modules"]:
+    if "import" in entry:
+      load(entry["import"])
+    elif module_manifest(f'{_environ_["module_dir"]}/{entry["item"]}')[2]:
+      with timed(f"resume {entry['item']}"):
+        load_module(entry["item"], reuse=True)
+    else:
+      with timed(f"stub {entry['item']}"):
+        load_lazy(entry["item"])
+  # the loaded modules registered their syntax again, anything else is added back
+  for kind, value in snapshot["statement"].items():
+    try:
+      if not isinstance(value, list):
+        _environ_["statement"].setdefault(kind, snapshot_resolve(value))
+        continue
+      for entry in value:
+        entry = tuple([snapshot_resolve(v) for v in entry])
+        if entry not in [tuple(e) for e in _environ_["statement"].setdefault(kind, [])]:
+          _environ_["statement"][kind].append(entry)
+    except (KeyError, AttributeError):
+      continue
+  invalidate_statements()
+  # the old environment refers to itself, so its views are only gone after a collection
+  gc.collect()
+  release_snapshot_maps(earlier)
 
 def push(**kwargs):
-  _environ_stack_.append(ProxyDict(_environ_, **kwargs))
-  
+  # names set until the matching pop land in this frame, the environment underneath is left alone
+  _scope_.push(kwargs)
+  invalidate_statements()
+  return "Environment Copy Pushed"
+
 def pop(*a):
-  _environ_ = _environ_stack_.pop()
+  if _scope_.depth() == 0:
+    print("Error: there is no pushed environment to pop")
+    return None
+  _scope_.pop()
+  invalidate_statements()
   return "Environment Copy Popped"
 
 def dowith(f, **kwargs):
-  push(**kwargs)
-  rtn = f()
-  pop()
-  return rtn
+  _scope_.push(kwargs)
+  try:
+    return f()
+  finally:
+    _scope_.pop()
+
+def lookup(name, default=None):
+  return _scope_.get(name, default)
 
 def initialize_environment(file_name):
   global _environ_
-  _environ_ = json.load(open(file_name, "r"))
+  with timed("read configuration"):
+    _environ_ = json.load(open(file_name, "r"))
+  _scope_.base = _environ_
+  _scope_.frames().clear()
   _environ_["modules"] = [sys.modules[__name__]] + _environ_["modules"]
   _environ_["env"] = _environ_
+  index_modules()
+  lazy = _environ_["init"].get("lazy", [])
   for module in _environ_["init"]["modules"]:
-    load(module)
-  run_file(_environ_["init"]["file"])
\ No newline at end of file
+    with timed(f"{'stub' if module in lazy else 'load'} {module}"):
+      if module in lazy:
+        load_lazy(module)
+      else:
+        load(module)
+  with timed("run init file"):
+    run_file(_environ_["init"]["file"])
\ No newline at end of file